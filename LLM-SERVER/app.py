@@ -1,15 +1,19 @@
 import os
+import json
 import uuid
 import re
 import logging
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, render_template, request, jsonify, session, make_response, url_for, g
 from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
 from docx import Document
 from dotenv import load_dotenv
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_pinecone import PineconeVectorStore
+from langchain_core.vectorstores import InMemoryVectorStore
 from langchain.chains import ConversationalRetrievalChain
-from langchain.schema import Document as LangchainDocument
+from langchain.chains.base import Chain
+from langchain.schema import Document as LangchainDocument, SystemMessage
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.prompts import ChatPromptTemplate, SystemMessagePromptTemplate, HumanMessagePromptTemplate
 from pinecone import Pinecone, ServerlessSpec
@@ -17,9 +21,35 @@ import langsmith
 from flask_cors import CORS
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+from contextlib import contextmanager
 import base64
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
+import hashlib
+import gzip
+from io import BytesIO
+from functools import lru_cache
+from PIL import Image
+try:
+    import brotli
+except ImportError:
+    brotli = None
+from tenacity import retry, stop_after_attempt, wait_fixed, wait_exponential, retry_if_exception_type
 import time
+import hmac
+import random
+import threading
+from singleflight import SingleFlight
+from jobs import JobQueue, PostgresJobStore
+from caching import LRUCache
+from batching import EmbeddingBatcher
+from title_router import TitleMatcher, TitleRoutedRetriever
+from profiling import StackSampler, new_profile_id, profile_path, save_profile, list_profiles
+from metrics import (
+    stage_timer, stage_config, metrics_handler, record_cache, record_embed_batch, render_metrics,
+    begin_token_usage, end_token_usage, set_response_path, record_token_usage, record_background_usage,
+    usage_report,
+    REQUEST_LATENCY, LLM_RETRIES, CACHE_LOOKUPS, CACHE_MISSES, TITLE_ROUTES
+)
 
 class LLMResponseError(Exception):
     pass
@@ -42,13 +72,74 @@ CORS(app, resources={r"/*": {"origins": [
 
 app.secret_key = os.urandom(24)  # Set a secret key for sessions
 
+# TLS ends at the proxy in front of the app; trust its X-Forwarded-Proto/Host so absolute
+# URLs (product images, upload status_url) use the public https:// origin. Set
+# TRUSTED_PROXY_HOPS to the number of proxies in front of the app, or 0 when exposed directly.
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1"))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(
+        app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS, x_host=TRUSTED_PROXY_HOPS
+    )
+
 # Access your API keys (set these in environment variables)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 TRANSCRIPT_INDEX_NAMES = ["bents", "shop-improvement", "tool-recommendations"]
 PRODUCT_INDEX_NAME = "bents-woodworking-products"
-os.environ["LANGCHAIN_TRACING_V2"] = "true"
-os.environ["LANGCHAIN_API_KEY"] = os.getenv("LANGSMITH_API_KEY")
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "256"))
+IMAGE_CACHE_MAX_AGE = 31536000  # one year; image URLs are content-addressed
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))  # bytes
+# Profiling is opt-in: an admin sends X-Profile: <token> (header only, so it never reaches access logs),
+# and PROFILE_SAMPLE_RATE profiles that fraction of traffic.
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILED_ENDPOINTS = {'chat'}
+# /metrics carries token and spend counters; scrapers send Authorization: Bearer <METRICS_TOKEN>.
+# Without a token configured, /metrics is disabled.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+CONVERSATION_HISTORY_TURNS = int(os.getenv("CONVERSATION_HISTORY_TURNS", "6"))  # most recent turns kept verbatim
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "2000"))  # summary + verbatim turns, approx. tokens
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "300"))
+# Turns and summaries older than this are deleted, checked at most once an hour per process
+CONVERSATION_RETENTION_DAYS = int(os.getenv("CONVERSATION_RETENTION_DAYS", "30"))
+# Per-stage LLM settings. Every stage uses LLM_MODEL unless LLM_<STAGE>_MODEL is set, and
+# LLM_<STAGE>_MAX_TOKENS, LLM_<STAGE>_TIMEOUT (seconds), LLM_<STAGE>_MAX_RETRIES and
+# LLM_<STAGE>_STOP ("|"-separated) override the defaults below. A max_tokens of None leaves
+# the output uncapped. Each retry can take up to the full timeout again, so the stages on
+# the path of every chat request retry little.
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini")
+LLM_STAGE_DEFAULTS = {
+    'relevance': {'max_tokens': 10, 'timeout': 10, 'max_retries': 0},  # a single label
+    'greeting': {'max_tokens': 150, 'timeout': 15, 'max_retries': 1},
+    'condense': {'max_tokens': 120, 'timeout': 15, 'max_retries': 1},
+    'answer': {'max_tokens': None, 'timeout': 60, 'max_retries': 1},
+    'summary': {'max_tokens': SUMMARY_MAX_TOKENS, 'timeout': 60, 'max_retries': 2},  # background
+}
+# "fast": skip the condense LLM call for standalone questions, reuse cached rewrites and
+# get the rewrite from the relevance call; "chain": let the chain always rewrite follow-ups
+CONDENSE_MODE = os.getenv("CONDENSE_MODE", "fast")
+CONDENSE_CACHE_SIZE = int(os.getenv("CONDENSE_CACHE_SIZE", "2048"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "2"))
+UPLOAD_BATCH_SIZE = int(os.getenv("UPLOAD_BATCH_SIZE", "32"))  # chunks per embed + upsert call
+# Concurrent question embeddings wait up to EMBED_BATCH_WAIT_MS to share one API call; 0 disables
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "5"))
+EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", "64"))
+EMBED_BATCH_IN_FLIGHT = int(os.getenv("EMBED_BATCH_IN_FLIGHT", "4"))  # concurrent batched calls
+EMBED_TIMEOUT = float(os.getenv("EMBED_TIMEOUT", "30"))  # seconds a question waits for its embedding
+# "pinecone" in production; "memory" keeps vectors in-process (used by bench/loadtest.py)
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "pinecone")
+# Without POSTGRES_URL (bench/loadtest.py when no database is available) product lookups
+# and server-side conversation history are skipped instead of failing on every request
+DATABASE_ENABLED = bool(os.getenv("POSTGRES_URL"))
+# Set by serve.py. Elsewhere (the Vercel function, which may be frozen once it responds)
+# uploads and conversation compaction run inline in the request instead of on a thread.
+BACKGROUND_JOBS = os.getenv("BACKGROUND_JOBS") == "1"
+# Upload job state: "postgres" (shared by all workers) or "memory" (single process only,
+# the default alongside the in-memory vector store, which is per process anyway)
+JOB_STORE = os.getenv("JOB_STORE", "memory" if VECTOR_STORE_BACKEND == "memory" else "postgres")
+os.environ.setdefault("LANGCHAIN_TRACING_V2", "true")
+os.environ["LANGCHAIN_API_KEY"] = os.getenv("LANGSMITH_API_KEY", "")
 os.environ["LANGCHAIN_ENDPOINT"] = "https://api.smith.langchain.com"
 os.environ["LANGCHAIN_PROJECT"] = "jason-json"
 
@@ -84,26 +175,70 @@ VIDEO_TITLE_LIST = [
     "Track Saw Square Comparison TSO ProductsBench Dogs UKWoodpeckers ToolsInsta Rail Square"
 ]
 
+# Questions naming a known video search only that video's chunks
+title_matcher = TitleMatcher(VIDEO_TITLE_LIST, min_score=float(os.getenv("TITLE_MATCH_MIN_SCORE", "0.6")))
+
+def title_filter(titles):
+    if VECTOR_STORE_BACKEND == "memory":
+        return lambda doc: doc.metadata.get('title') in titles
+    return {'title': {'$in': titles}}
+
 # Initialize Langchain components
-embeddings = OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY)
-llm = ChatOpenAI(openai_api_key=OPENAI_API_KEY, model="gpt-4o-mini", temperature=0)
-
-# Initialize Pinecone
-pc = Pinecone(api_key=PINECONE_API_KEY)
-
-# Create or connect to the Pinecone indexes
-for INDEX_NAME in TRANSCRIPT_INDEX_NAMES + [PRODUCT_INDEX_NAME]:
-    if INDEX_NAME not in pc.list_indexes().names():
-        pc.create_index(
-            name=INDEX_NAME,
-            dimension=1536,  # OpenAI embeddings dimension
-            metric='cosine',
-            spec=ServerlessSpec(cloud='aws', region='us-east-1')
-        )
+embeddings = EmbeddingBatcher(
+    # The context-length check tokenizes with tiktoken, which downloads its encoding on
+    # first use; the memory backend (bench/loadtest.py) must run without network access
+    OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY, check_embedding_ctx_length=VECTOR_STORE_BACKEND != "memory"),
+    max_batch_size=EMBED_BATCH_MAX,
+    max_wait=EMBED_BATCH_WAIT_MS / 1000,
+    max_in_flight=EMBED_BATCH_IN_FLIGHT,
+    timeout=EMBED_TIMEOUT,
+    on_batch=record_embed_batch,
+)
+
+def stage_llm_settings(stage):
+    defaults = LLM_STAGE_DEFAULTS[stage]
+    prefix = f"LLM_{stage.upper()}_"
+    max_tokens = os.getenv(prefix + "MAX_TOKENS")
+    timeout = os.getenv(prefix + "TIMEOUT")
+    max_retries = os.getenv(prefix + "MAX_RETRIES")
+    stop = os.getenv(prefix + "STOP")
+    return {
+        'model': os.getenv(prefix + "MODEL", LLM_MODEL),
+        'max_tokens': int(max_tokens) if max_tokens else defaults['max_tokens'],
+        'timeout': float(timeout) if timeout else defaults['timeout'],
+        'max_retries': int(max_retries) if max_retries else defaults['max_retries'],
+        'stop': stop.split('|') if stop else None,
+    }
+
+# The stage tag sits on the model so it reaches the LLM run even when the model is
+# called from inside a chain (chain-level tags are not passed down to child runs)
+stage_llms = {
+    stage: ChatOpenAI(
+        openai_api_key=OPENAI_API_KEY, temperature=0, tags=[f'stage:{stage}'], **stage_llm_settings(stage)
+    )
+    for stage in LLM_STAGE_DEFAULTS
+}
 
-# Create VectorStores
-transcript_vector_stores = {name: PineconeVectorStore(index=pc.Index(name), embedding=embeddings, text_key="text") for name in TRANSCRIPT_INDEX_NAMES}
-product_vector_store = PineconeVectorStore(index=pc.Index(PRODUCT_INDEX_NAME), embedding=embeddings, text_key="tags")
+if VECTOR_STORE_BACKEND == "memory":
+    transcript_vector_stores = {name: InMemoryVectorStore(embedding=embeddings) for name in TRANSCRIPT_INDEX_NAMES}
+    product_vector_store = InMemoryVectorStore(embedding=embeddings)
+else:
+    # Initialize Pinecone
+    pc = Pinecone(api_key=PINECONE_API_KEY)
+
+    # Create or connect to the Pinecone indexes
+    for INDEX_NAME in TRANSCRIPT_INDEX_NAMES + [PRODUCT_INDEX_NAME]:
+        if INDEX_NAME not in pc.list_indexes().names():
+            pc.create_index(
+                name=INDEX_NAME,
+                dimension=1536,  # OpenAI embeddings dimension
+                metric='cosine',
+                spec=ServerlessSpec(cloud='aws', region='us-east-1')
+            )
+
+    # Create VectorStores
+    transcript_vector_stores = {name: PineconeVectorStore(index=pc.Index(name), embedding=embeddings, text_key="text") for name in TRANSCRIPT_INDEX_NAMES}
+    product_vector_store = PineconeVectorStore(index=pc.Index(PRODUCT_INDEX_NAME), embedding=embeddings, text_key="tags")
 
 # System instructions
 SYSTEM_INSTRUCTIONS = """You are an AI assistant specialized in information retrieval from text documents.
@@ -129,31 +264,64 @@ Then show that is in generated response with the provided context.
 
 logging.basicConfig(level=logging.DEBUG)
 
+_db_pool = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises instead of waiting when exhausted; queue callers here
+_db_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+def get_db_pool():
+    """Per-process Postgres pool, created lazily so preforked workers never share sockets."""
+    global _db_pool, _db_pool_pid
+    with _db_pool_lock:
+        if _db_pool is None or _db_pool_pid != os.getpid():
+            _db_pool = ThreadedConnectionPool(1, DB_POOL_MAX, os.getenv("POSTGRES_URL"))
+            _db_pool_pid = os.getpid()
+        return _db_pool
+
+@contextmanager
+def db_connection():
+    with _db_slots:
+        pool = get_db_pool()
+        conn = pool.getconn()
+        try:
+            yield conn
+        finally:
+            # End any open transaction before the connection goes back to the pool;
+            # connections that can't do that are broken and get discarded
+            try:
+                conn.rollback()
+                pool.putconn(conn)
+            except psycopg2.Error:
+                pool.putconn(conn, close=True)
+
 def get_matched_products(video_title):
     logging.debug(f"Attempting to get matched products for title: {video_title}")
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            # Query for partial matches in the title, case-insensitive
-            query = """
-                SELECT * FROM products 
-                WHERE LOWER(tags) LIKE LOWER(%s)
-            """
-            search_term = f"%{video_title}%"
-            logging.debug(f"Executing SQL query: {query} with search term: {search_term}")
-            cur.execute(query, (search_term,))
-            matched_products = cur.fetchall()
-            logging.debug(f"Raw matched products from database: {matched_products}")
-        conn.close()
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                # Query for partial matches in the tags, case-insensitive.
+                # Served by the products_tags_trgm_idx trigram index (see migrations/).
+                query = """
+                    SELECT id, title, tag_list, link, image_hash FROM products
+                    WHERE LOWER(tags) LIKE LOWER(%s)
+                """
+                search_term = f"%{video_title}%"
+                logging.debug(f"Executing SQL query: {query} with search term: {search_term}")
+                cur.execute(query, (search_term,))
+                matched_products = cur.fetchall()
+                logging.debug(f"Raw matched products from database: {matched_products}")
 
         # Process the results
         related_products = [
             {
                 'id': product['id'],
                 'title': product['title'],
-                'tags': product['tags'].split(',') if product['tags'] else [],
+                'tags': product['tag_list'],
                 'link': product['link'],
-                'image_data': product['image_data'] if 'image_data' in product else None
+                'image_hash': product['image_hash'],
+                'image_url': product_image_url(product['image_hash']),
+                'thumbnail_url': product_image_url(product['image_hash'], thumbnail=True)
             } for product in matched_products
         ]
 
@@ -166,19 +334,243 @@ def get_matched_products(video_title):
 
 
 
+def load_conversation_history(conversation_id, limit=CONVERSATION_HISTORY_TURNS):
+    """Running summary and the most recent unsummarized turns of a conversation.
+
+    Returns (summary, turns, needs_compaction); turns are (question, answer)
+    pairs, oldest first, limited to the verbatim window (verbatim_turn_count).
+    needs_compaction is True once unsummarized turns fall outside that window,
+    so they get folded into the summary rather than silently dropped.
+    """
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT summary, summarized_through FROM conversation_summaries WHERE conversation_id = %s",
+                    (conversation_id,)
+                )
+                row = cur.fetchone()
+                summary, summarized_through = row if row else (None, 0)
+                cur.execute(
+                    """
+                    SELECT question, answer FROM conversation_turns
+                    WHERE conversation_id = %s AND id > %s
+                    ORDER BY id DESC
+                    LIMIT %s
+                    """,
+                    (conversation_id, summarized_through, limit + 1)
+                )
+                rows = cur.fetchall()
+        turns = [(question, answer) for question, answer in reversed(rows[:limit])]
+        keep = verbatim_turn_count(turns)
+        return summary, turns[len(turns) - keep:], len(rows) > keep
+    except Exception as e:
+        logging.error(f"Error loading conversation history: {str(e)}", exc_info=True)
+        return None, [], False
+
+def estimate_tokens(text):
+    # ~4 characters per token for English; good enough for a budget check
+    return len(text) // 4 + 1
+
+def truncate_to_tokens(text, max_tokens):
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    return text[:max(max_tokens - 1, 0) * 4]
+
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+def verbatim_turn_count(turns, budget=None):
+    """How many of the newest turns are kept verbatim: at most CONVERSATION_HISTORY_TURNS,
+    within the history budget left after room for the summary, and always the newest one.
+
+    Both load_conversation_history and compact_conversation use this, so every turn is
+    either in the verbatim window or folded into the summary.
+    """
+    if budget is None:
+        budget = HISTORY_TOKEN_BUDGET - SUMMARY_MAX_TOKENS - estimate_tokens(SUMMARY_PREFIX)
+    used = count = 0
+    for question, answer in reversed(turns[-CONVERSATION_HISTORY_TURNS:]):
+        used += estimate_tokens(question) + estimate_tokens(answer)
+        if count and used > budget:
+            break
+        count += 1
+    return count
+
+def build_history(summary, turns, budget=HISTORY_TOKEN_BUDGET):
+    """Summary (as a system message) followed by as many recent turns as fit the budget.
+
+    The budget is a hard cap: an oversized summary or newest turn is truncated to fit.
+    The summary gets at most SUMMARY_MAX_TOKENS, the room verbatim_turn_count reserves
+    for it, so the turns load_conversation_history returns always fit.
+    """
+    summary_message = None
+    remaining = budget
+    if summary:
+        summary_budget = min(SUMMARY_MAX_TOKENS, budget - estimate_tokens(SUMMARY_PREFIX))
+        summary_message = SystemMessage(content=SUMMARY_PREFIX + truncate_to_tokens(summary, summary_budget))
+        remaining -= estimate_tokens(summary_message.content)
+    kept = []
+    for question, answer in reversed(turns):
+        cost = estimate_tokens(question) + estimate_tokens(answer)
+        if cost > remaining:
+            # Keep the start of the newest turn rather than drop all context. Older turns
+            # only reach this point for client-sent chat_history, which has no summary.
+            if not kept and remaining >= 2:
+                question = truncate_to_tokens(question, remaining - 1)
+                answer = truncate_to_tokens(answer, remaining - estimate_tokens(question))
+                kept.append((question, answer))
+            break
+        kept.append((question, answer))
+        remaining -= cost
+    kept.reverse()
+    if summary_message is not None:
+        return [summary_message] + kept
+    return kept
+
+SUMMARY_PROMPT = """You maintain a running summary of a conversation between a user and a woodworking assistant representing Jason Bent.
+Update the summary with the new turns below. Keep the topics, tools, products, videos and open questions the user cares about. Be concise.
+
+Current summary:
+{summary}
+
+New turns:
+{turns}
+
+Updated summary:"""
+
+def compact_conversation(report, conversation_id):
+    """Fold turns outside the verbatim window into the running summary."""
+    # Summary tokens are accounted separately from the chat requests that triggered them
+    usage = begin_token_usage()
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT summary, summarized_through FROM conversation_summaries WHERE conversation_id = %s",
+                    (conversation_id,)
+                )
+                row = cur.fetchone()
+                summary, summarized_through = row if row else (None, 0)
+                cur.execute(
+                    "SELECT id, question, answer FROM conversation_turns WHERE conversation_id = %s AND id > %s ORDER BY id",
+                    (conversation_id, summarized_through)
+                )
+                turns = cur.fetchall()
+        to_fold = turns[:len(turns) - verbatim_turn_count([(q, a) for _, q, a in turns])]
+        report(turns_folded=len(to_fold))
+        if not to_fold:
+            return
+
+        # No connection is held during the LLM call; /chat requests wait on the pool
+        prompt = SUMMARY_PROMPT.format(
+            summary=summary or "None yet",
+            turns="\n".join(f"Human: {question}\nAssistant: {answer}" for _, question, answer in to_fold)
+        )
+        # Timed by StageMetricsHandler through the stage tag
+        new_summary = stage_llms['summary'].invoke(prompt, config=stage_config('summary')).content
+
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                # Another worker may have compacted further in the meantime; never move backwards
+                cur.execute(
+                    """
+                    INSERT INTO conversation_summaries (conversation_id, summary, summarized_through)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (conversation_id) DO UPDATE
+                    SET summary = EXCLUDED.summary, summarized_through = EXCLUDED.summarized_through, updated_at = NOW()
+                    WHERE conversation_summaries.summarized_through < EXCLUDED.summarized_through
+                    """,
+                    (conversation_id, new_summary, to_fold[-1][0])
+                )
+            conn.commit()
+    finally:
+        end_token_usage(usage)
+        record_background_usage('compaction', usage)
+        with compacting_lock:
+            compacting.discard(conversation_id)
+
+def schedule_compaction(conversation_id):
+    # At most one pending compaction per conversation
+    with compacting_lock:
+        if conversation_id in compacting:
+            return
+        compacting.add(conversation_id)
+    summary_jobs.submit(compact_conversation, conversation_id)
+
+conversations_pruned_at = {'time': 0.0}
+
+def append_conversation_turn(conversation_id, selected_index, question, answer):
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO conversation_turns (conversation_id, selected_index, question, answer) VALUES (%s, %s, %s, %s)",
+                    (conversation_id, selected_index, question, answer)
+                )
+                if time.time() - conversations_pruned_at['time'] > 3600:
+                    conversations_pruned_at['time'] = time.time()
+                    prune_conversations(cur)
+            conn.commit()
+    except Exception as e:
+        logging.error(f"Error saving conversation turn: {str(e)}", exc_info=True)
+
+def prune_conversations(cur):
+    # Like finished jobs (PostgresJobStore.create), history is not kept forever
+    cur.execute(
+        "DELETE FROM conversation_turns WHERE created_at < NOW() - make_interval(days => %s)",
+        (CONVERSATION_RETENTION_DAYS,)
+    )
+    cur.execute(
+        "DELETE FROM conversation_summaries WHERE updated_at < NOW() - make_interval(days => %s)",
+        (CONVERSATION_RETENTION_DAYS,)
+    )
+
+def product_image_url(image_hash, thumbnail=False):
+    if not image_hash:
+        return None
+    endpoint = 'product_thumbnail' if thumbnail else 'product_image'
+    return url_for(endpoint, image_hash=image_hash, _external=True)
+
+def fetch_product_image(image_hash):
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT image_data FROM products WHERE image_hash = %s LIMIT 1", (image_hash,))
+            row = cur.fetchone()
+    return bytes(row[0]) if row and row[0] is not None else None
+
+@lru_cache(maxsize=256)
+def make_thumbnail(image_hash):
+    # Keyed by content hash, so cached thumbnails never go stale
+    CACHE_MISSES.labels('thumbnail').inc()
+    image_data = fetch_product_image(image_hash)
+    if image_data is None:
+        return None
+    img = Image.open(BytesIO(image_data))
+    img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    out = BytesIO()
+    img.convert('RGB').save(out, format='JPEG', quality=85, optimize=True)
+    return out.getvalue()
+
+def image_response(image_hash, image_data, mimetype):
+    response = make_response(image_data)
+    response.mimetype = mimetype
+    response.set_etag(image_hash)
+    # Content-addressed: the URL changes whenever the image does
+    response.headers['Cache-Control'] = f'public, max-age={IMAGE_CACHE_MAX_AGE}, immutable'
+    return response.make_conditional(request)
+
 # Add a function to verify database connection and content
 def verify_database():
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT COUNT(*) FROM products")
-            count = cur.fetchone()['count']
-            logging.info(f"Total products in database: {count}")
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT COUNT(*) FROM products")
+                count = cur.fetchone()['count']
+                logging.info(f"Total products in database: {count}")
             
-            cur.execute("SELECT title FROM products LIMIT 5")
-            sample_titles = [row['title'] for row in cur.fetchall()]
-            logging.info(f"Sample product titles: {sample_titles}")
-        conn.close()
+                cur.execute("SELECT title FROM products LIMIT 5")
+                sample_titles = [row['title'] for row in cur.fetchall()]
+                logging.info(f"Sample product titles: {sample_titles}")
         return True
     except Exception as e:
         logging.error(f"Database verification failed: {str(e)}", exc_info=True)
@@ -225,7 +617,17 @@ def extract_metadata_from_text(text):
     title = text.split('\n')[0] if text else "Untitled Video"
     return {"title": title}
 
-def upsert_transcript(transcript_text, metadata, index_name):
+@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, max=10), reraise=True)
+def upsert_batch(index_name, documents):
+    # Ids derive from chunk_id and the chunk text: a retried batch overwrites rather than
+    # duplicates, while transcripts sharing a title (or a blank first line) keep their own vectors
+    ids = [
+        hashlib.sha1(f"{doc.metadata['chunk_id']}\n{doc.page_content}".encode()).hexdigest()
+        for doc in documents
+    ]
+    transcript_vector_stores[index_name].add_documents(documents, ids=ids)
+
+def upsert_transcript(transcript_text, metadata, index_name, report=None):
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
     chunks = text_splitter.split_text(transcript_text)
     
@@ -236,13 +638,438 @@ def upsert_transcript(transcript_text, metadata, index_name):
         chunk_metadata['url'] = metadata.get('url', '')
         documents.append(LangchainDocument(page_content=chunk, metadata=chunk_metadata))
     
-    transcript_vector_stores[index_name].add_documents(documents)
+    if report:
+        report(stage='embedding', chunks_total=len(documents), chunks_upserted=0)
+    for start in range(0, len(documents), UPLOAD_BATCH_SIZE):
+        batch = documents[start:start + UPLOAD_BATCH_SIZE]
+        upsert_batch(index_name, batch)
+        if report:
+            report(chunks_upserted=start + len(batch))
+
+def process_upload(report, file_path, index_name):
+    try:
+        report(stage='parsing')
+        transcript_text = extract_text_from_docx(file_path)
+        metadata = extract_metadata_from_text(transcript_text)
+        report(title=metadata['title'])
+        upsert_transcript(transcript_text, metadata, index_name, report)
+        report(stage='done')
+    finally:
+        os.remove(file_path)
+
+def select_fields(payload):
+    """Keep only the fields the client asked for via `fields` (JSON body or query string)."""
+    data = request.get_json(silent=True) or {}
+    fields = data.get('fields') or request.args.get('fields')
+    if not fields:
+        return payload
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    fields = {f.strip() for f in fields}
+    return {k: v for k, v in payload.items() if k in fields}
+
+def chat_response(payload):
+    return jsonify(select_fields(payload))
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    if 'request_start' in g:
+        REQUEST_LATENCY.labels(request.endpoint or 'unknown', request.method, response.status_code).observe(
+            time.perf_counter() - g.request_start
+        )
+    return response
+
+@app.before_request
+def start_token_accounting():
+    # CORS preflights (OPTIONS) also resolve to the chat endpoint
+    if request.endpoint == 'chat' and request.method == 'POST':
+        g.token_usage = begin_token_usage()
+
+@app.teardown_request
+def finish_token_accounting(exc):
+    usage = g.pop('token_usage', None)
+    if usage is None:
+        return
+    end_token_usage(usage)
+    record_token_usage(usage)
+    logging.info(f"chat_usage {json.dumps(usage.as_dict())}")
+
+def is_profile_admin():
+    token = request.headers.get('X-Profile')
+    return bool(PROFILE_ADMIN_TOKEN and token and hmac.compare_digest(token, PROFILE_ADMIN_TOKEN))
+
+@app.before_request
+def start_profiler():
+    if request.endpoint not in PROFILED_ENDPOINTS or request.method != 'POST':
+        return
+    if is_profile_admin() or (PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE):
+        g.profile_id = new_profile_id()
+        g.profiler = StackSampler(threading.get_ident()).start()
+
+@app.after_request
+def add_profile_header(response):
+    if 'profile_id' in g:
+        response.headers['X-Profile-Id'] = g.profile_id
+    return response
+
+@app.teardown_request
+def stop_profiler(exc):
+    # Runs after every after_request hook, so compression is included in the profile
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return
+    profiler.stop()
+    try:
+        save_profile(g.profile_id, profiler)
+        logging.info(f"Saved profile {g.profile_id}: {profiler.samples} samples over {profiler.elapsed:.3f}s")
+    except OSError as e:
+        logging.error(f"Failed to save profile {g.profile_id}: {str(e)}")
+
+@app.route('/profiles')
+def get_profiles():
+    if not is_profile_admin():
+        return jsonify({'error': 'Forbidden'}), 403
+    return jsonify({'profiles': list_profiles()})
+
+@app.route('/profiles/<profile_id>')
+def get_profile(profile_id):
+    if not is_profile_admin():
+        return jsonify({'error': 'Forbidden'}), 403
+    path = profile_path(profile_id)
+    if path is None or not os.path.exists(path):
+        return jsonify({'error': 'Profile not found'}), 404
+    with open(path) as f:
+        folded = f.read()
+    response = make_response(folded)
+    response.mimetype = 'text/plain'
+    response.headers['Content-Disposition'] = f'attachment; filename={profile_id}.folded'
+    return response
+
+@app.after_request
+def compress_response(response):
+    if (response.direct_passthrough
+            or response.mimetype != 'application/json'
+            or 'Content-Encoding' in response.headers
+            or response.status_code < 200 or response.status_code >= 300):
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    accept_encoding = request.accept_encodings
+    if brotli is not None and accept_encoding['br']:
+        response.set_data(brotli.compress(data, quality=5))
+        response.headers['Content-Encoding'] = 'br'
+    elif accept_encoding['gzip']:
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        return response
+    response.vary.add('Accept-Encoding')
+    return response
+
+# Filled in by warmup(); the dev server and serverless never warm up and report ready
+warmup_state = {'steps': {}}
+
+def open_db_pool():
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+
+def prime_product_index():
+    with app.test_request_context():
+        get_matched_products(VIDEO_TITLE_LIST[0])
+
+def warmup_steps():
+    steps = {'chains': lambda: [get_qa_chain(name) for name in TRANSCRIPT_INDEX_NAMES]}
+    if DATABASE_ENABLED:
+        steps.update(db_pool=open_db_pool, product_index=prime_product_index)
+    steps['embeddings'] = lambda: embeddings.embed_query("warmup")
+    return steps
+
+def warmup(only=None):
+    """Prime per-process resources so a worker's first requests aren't slow.
+
+    serve.py runs this in each worker after fork and before the worker accepts
+    traffic: connections and client pools opened here must not be shared across
+    processes. `only` re-runs just the named steps.
+    """
+    for name, fn in warmup_steps().items():
+        if only is not None and name not in only:
+            continue
+        start = time.perf_counter()
+        try:
+            fn()
+            warmup_state['steps'][name] = {'ok': True}
+        except Exception as e:
+            logging.error(f"Warmup step {name} failed: {str(e)}", exc_info=True)
+            warmup_state['steps'][name] = {'ok': False, 'error': str(e)}
+        warmup_state['steps'][name]['seconds'] = round(time.perf_counter() - start, 3)
+    logging.info(f"Worker {os.getpid()} warm: {warmup_state['steps']}")
+
+def failed_warmup_steps():
+    return [name for name, result in warmup_state['steps'].items() if not result['ok']]
+
+@app.route('/ready')
+def ready():
+    # Workers only serve once warmup has run, so not ready means a step failed (e.g. the
+    # database was down). Failed steps are retried here so the worker recovers on its own.
+    if failed_warmup_steps():
+        warmup(only=failed_warmup_steps())
+    if failed_warmup_steps():
+        return jsonify({'ready': False, 'steps': warmup_state['steps']}), 503
+    return jsonify({'ready': True, 'steps': warmup_state['steps']})
+
+@app.route('/usage')
+def usage():
+    # Spend figures are admin-only, like the profiles (and /metrics needs METRICS_TOKEN)
+    if not is_profile_admin():
+        return jsonify({'error': 'Forbidden'}), 403
+    return jsonify(usage_report())
+
+@app.route('/metrics')
+def metrics():
+    authorization = request.headers.get('Authorization', '')
+    if not (METRICS_TOKEN and hmac.compare_digest(authorization, f"Bearer {METRICS_TOKEN}")):
+        return jsonify({'error': 'Forbidden'}), 403
+    body, content_type = render_metrics()
+    return app.response_class(body, content_type=content_type)
 
 @app.route('/')
 @app.route('/database')
 def serve_spa():
     return render_template('index.html')
 
+chat_flight = SingleFlight()
+upload_jobs = JobQueue(
+    max_workers=UPLOAD_WORKERS, name='upload', inline=not BACKGROUND_JOBS,
+    store=PostgresJobStore(db_connection, kind='upload') if JOB_STORE == "postgres" else None
+)
+# Conversation summaries are updated off the request path
+summary_jobs = JobQueue(max_workers=1, name='summary', inline=not BACKGROUND_JOBS)
+compacting = set()
+compacting_lock = threading.Lock()
+
+def normalize_question(question):
+    return re.sub(r'\s+', ' ', question).strip().rstrip('?!.').lower()
+
+condense_cache = LRUCache(maxsize=CONDENSE_CACHE_SIZE)
+
+# Words that usually point back at earlier turns ("how long does it take?", "what about the other one?")
+FOLLOW_UP_PATTERN = re.compile(
+    r"\b(it|its|it's|that|this|these|those|them|they|their|he|she|him|his|her|one|ones|there|"
+    r"same|else|more|also|too|above|previous|former|latter|again)\b|^\s*(and|but|so|what about|how about)\b",
+    re.IGNORECASE
+)
+
+REWRITE_INSTRUCTIONS = """
+    If the response is RELEVANT, add a second line in the form
+    STANDALONE: <the current question rewritten as a standalone question, using the chat history to resolve references>
+    """
+
+def is_standalone_question(question):
+    return len(question.split()) >= 4 and not FOLLOW_UP_PATTERN.search(question)
+
+def condense_cache_key(user_query, recent_turns):
+    return (normalize_question(user_query), recent_turns[-1])
+
+class PrecomputedQuestionChain(Chain):
+    """Stands in for the condense step when the standalone question is already known."""
+    standalone_question: str
+
+    @property
+    def input_keys(self):
+        return ['question', 'chat_history']
+
+    @property
+    def output_keys(self):
+        return ['text']
+
+    def _call(self, inputs, run_manager=None):
+        return {'text': self.standalone_question}
+
+QA_PROMPT = ChatPromptTemplate.from_messages([
+    SystemMessagePromptTemplate.from_template(SYSTEM_INSTRUCTIONS),
+    HumanMessagePromptTemplate.from_template("Context: {context}\n\nChat History: {chat_history}\n\nQuestion: {question}")
+])
+
+def build_retriever(selected_index):
+    return TitleRoutedRetriever(
+        vector_store=transcript_vector_stores[selected_index],
+        matcher=title_matcher,
+        make_filter=title_filter,
+        k=3,
+        on_route=lambda result: TITLE_ROUTES.labels(result).inc()
+    )
+
+@lru_cache(maxsize=None)
+def get_qa_chain(selected_index):
+    """Per-index QA chain, built once per process. Chains hold no per-request state,
+    so one instance serves concurrent requests; never mutate it in place."""
+    return build_qa_chain(build_retriever(selected_index))
+
+def build_qa_chain(retriever):
+    qa_chain = ConversationalRetrievalChain.from_llm(
+        llm=stage_llms['answer'],
+        condense_question_llm=stage_llms['condense'],
+        retriever=retriever,
+        combine_docs_chain_kwargs={"prompt": QA_PROMPT},
+        return_source_documents=True
+    )
+    return qa_chain
+
+def run_chat_pipeline(user_query, selected_index, formatted_history):
+    """Relevance check, retrieval and answer for one question. Returns (payload, status)."""
+    recent_turns = [turn for turn in formatted_history if isinstance(turn, tuple)]
+
+    # Try to avoid the chain's condense-question LLM call for follow-ups
+    standalone_question = None
+    ask_for_rewrite = False
+    if recent_turns and CONDENSE_MODE == 'fast':
+        if is_standalone_question(user_query):
+            standalone_question = user_query
+        else:
+            standalone_question = condense_cache.get(condense_cache_key(user_query, recent_turns))
+            record_cache('condense', hit=standalone_question is not None)
+            ask_for_rewrite = standalone_question is None
+
+    # Relevance check
+    relevance_check_prompt = f"""
+    Given the following question or message and the chat history, determine if it is:
+    1. A greeting or general conversation starter
+    2. Related to woodworking, tools, home improvement, or the assistant's capabilities and also query about bents-woodworking youtube channel general questions.
+    3. Related to the company, its products, services, or business operations
+    4. A continuation or follow-up question to the previous conversation
+    5. Related to violence, harmful activities, or other inappropriate content
+    6. Completely unrelated to the above topics and not a continuation of the conversation
+    7. if user is asking about jason bents.
+
+    If it falls under category 1, respond with 'GREETING'.
+    If it falls under categories 2, 3, 4 or 7 respond with 'RELEVANT'.
+    If it falls under category 5, respond with 'INAPPROPRIATE'.
+    If it falls under category 6, respond with 'NOT RELEVANT'.
+
+    Chat History:
+    {recent_turns[-3:] if recent_turns else "No previous context"}
+
+    Current Question: {user_query}
+    {REWRITE_INSTRUCTIONS if ask_for_rewrite else ""}
+    Response (GREETING, RELEVANT, INAPPROPRIATE, or NOT RELEVANT):
+    """
+
+    relevance_llm = stage_llms['relevance']
+    rewrite_tokens = stage_llms['condense'].max_tokens
+    if ask_for_rewrite and relevance_llm.max_tokens is not None and rewrite_tokens is not None:
+        # The rewritten question follows the label, so allow the condense stage's budget for it
+        relevance_llm = relevance_llm.bind(max_tokens=relevance_llm.max_tokens + rewrite_tokens)
+    # LLM stages are timed by StageMetricsHandler; wrapping them in stage_timer would count them twice
+    relevance_response = relevance_llm.invoke(relevance_check_prompt, config=stage_config('relevance')).content
+
+    # The label is on the first line; a STANDALONE rewrite may follow
+    relevance_label = relevance_response.split('STANDALONE:')[0].strip().split('\n')[0].upper()
+    if ask_for_rewrite:
+        match = re.search(r'STANDALONE:\s*(.+)', relevance_response)
+        if match:
+            standalone_question = match.group(1).strip()
+            condense_cache.set(condense_cache_key(user_query, recent_turns), standalone_question)
+
+    if "GREETING" in relevance_label:
+        greeting_response = stage_llms['greeting'].invoke(
+            "Generate a friendly greeting response for a woodworking assistant.",
+            config=stage_config('greeting')
+        ).content
+        set_response_path('greeting')
+        return {
+            'response': greeting_response,
+            'related_products': [],
+            'url': None,
+            'context': [],
+            'video_links': {}
+        }, 200
+    elif "INAPPROPRIATE" in relevance_label:
+        set_response_path('rejected')
+        return {
+            'response': "I'm sorry, but this is outside my context of answering. Is there something else I can help you with regarding woodworking, tools, or home improvement?",
+            'related_products': [],
+            'url': None,
+            'context': [],
+            'video_links': {}
+        }, 200
+    elif "NOT RELEVANT" in relevance_label:
+        set_response_path('rejected')
+        return {
+            'response': "I'm sorry, but I'm specialized in topics related to our company, woodworking, tools, and home improvement. I can also engage in general conversation or continue our previous discussion. Could you please ask a question related to these topics, continue our previous conversation, or start with a greeting?",
+            'related_products': [],
+            'url': None,
+            'context': [],
+            'video_links': {}
+        }, 200
+
+    # If we reach here, the query is relevant and not a greeting
+    qa_chain = get_qa_chain(selected_index)
+    if standalone_question is not None:
+        # A shallow copy, so the shared chain keeps its condense step
+        qa_chain = qa_chain.model_copy(
+            update={'question_generator': PrecomputedQuestionChain(standalone_question=standalone_question)}
+        )
+
+    try:
+        with stage_timer('qa_chain'):
+            result = retry_llm_call(qa_chain, user_query, formatted_history)
+    except LLMResponseError as e:
+        error_message = "Failed to get a complete response from the AI after multiple attempts."
+        if isinstance(e, LLMNoResponseError):
+            error_message = "The AI failed to generate a response after multiple attempts."
+        return {'error': error_message}, 500
+    except Exception as e:
+        logging.error(f"Unexpected error in LLM call: {str(e)}")
+        return {'error': 'An unexpected error occurred while processing your request.'}, 500
+
+    initial_answer = result['answer']
+    context = [doc.page_content for doc in result['source_documents']]
+    source_documents = result['source_documents']
+
+    # Extract video title from metadata of the first source document
+    video_title = "Unknown Video"
+    url = None
+    if source_documents:
+        metadata = source_documents[0].metadata
+        video_title = metadata.get('title', "Unknown Video")
+        url = metadata.get('url', None)
+
+    logging.debug(f"Extracted video title from chunk metadata: {video_title}")
+
+    # Process the answer to replace timestamps and extract video links
+    with stage_timer('process_answer'):
+        processed_answer, video_dict = process_answer(initial_answer, url)
+
+    logging.debug(f"Processed answer: {processed_answer}")
+
+    # Get matched products based on video title
+    related_products = []
+    if DATABASE_ENABLED:
+        with stage_timer('products'):
+            related_products = get_matched_products(video_title)
+
+    logging.debug(f"Retrieved matched products: {related_products}")
+
+    response_data = {
+        'response': processed_answer,
+        'initial_answer': initial_answer,
+        'related_products': related_products,
+        'url': url,
+        'context': context,
+        'video_links': video_dict,
+        'video_title': video_title
+    }
+
+    set_response_path('answered')
+    return response_data, 200
+
 @app.route('/chat', methods=['POST'])
 def chat():
     try:
@@ -252,12 +1079,28 @@ def chat():
         user_query = data['message'].strip()
         selected_index = data['selected_index']
         chat_history = data.get('chat_history', [])
+        conversation_id = data.get('conversation_id')
+        g.token_usage.index = selected_index if selected_index in TRANSCRIPT_INDEX_NAMES else 'other'
 
         logging.debug(f"Chat history received: {chat_history}")
 
+        if not DATABASE_ENABLED:
+            # No database to keep history in; the client's chat_history is used
+            conversation_id = None
+        elif conversation_id is not None:
+            try:
+                conversation_id = str(uuid.UUID(conversation_id))
+            except (ValueError, TypeError, AttributeError):
+                return jsonify({'error': 'Invalid conversation_id'}), 400
+        new_conversation = DATABASE_ENABLED and conversation_id is None and not chat_history
+        if new_conversation:
+            # History is kept server-side from here on; there is none to load yet
+            conversation_id = str(uuid.uuid4())
+
         # Initial input validation
         if not user_query or user_query in ['.', ',', '?', '!']:
-            return jsonify({
+            set_response_path('rejected')
+            return chat_response({
                 'response': "I'm sorry, but I didn't receive a valid question. Could you please ask a complete question?",
                 'related_products': [],
                 'url': None,
@@ -266,131 +1109,44 @@ def chat():
             })
 
         # Format chat history for ConversationalRetrievalChain
-        formatted_history = []
-        for i in range(0, len(chat_history) - 1, 2):
-            human = chat_history[i]
-            ai = chat_history[i + 1] if i + 1 < len(chat_history) else ""
-            formatted_history.append((human, ai))
+        needs_compaction = False
+        if conversation_id is not None and not new_conversation:
+            with stage_timer('history'):
+                summary, turns, needs_compaction = load_conversation_history(conversation_id)
+        else:
+            summary, turns = None, []
+            for i in range(0, len(chat_history) - 1, 2):
+                human = chat_history[i]
+                ai = chat_history[i + 1] if i + 1 < len(chat_history) else ""
+                turns.append((human, ai))
+        formatted_history = build_history(summary, turns)
 
         logging.debug(f"Formatted chat history: {formatted_history}")
 
-        # Relevance check
-        relevance_check_prompt = f"""
-        Given the following question or message and the chat history, determine if it is:
-        1. A greeting or general conversation starter
-        2. Related to woodworking, tools, home improvement, or the assistant's capabilities and also query about bents-woodworking youtube channel general questions.
-        3. Related to the company, its products, services, or business operations
-        4. A continuation or follow-up question to the previous conversation
-        5. Related to violence, harmful activities, or other inappropriate content
-        6. Completely unrelated to the above topics and not a continuation of the conversation
-        7. if user is asking about jason bents.
-
-        If it falls under category 1, respond with 'GREETING'.
-        If it falls under categories 2, 3, 4 or 7 respond with 'RELEVANT'.
-        If it falls under category 5, respond with 'INAPPROPRIATE'.
-        If it falls under category 6, respond with 'NOT RELEVANT'.
-
-        Chat History:
-        {formatted_history[-3:] if formatted_history else "No previous context"}
-
-        Current Question: {user_query}
-        
-        Response (GREETING, RELEVANT, INAPPROPRIATE, or NOT RELEVANT):
-        """
-        
-        relevance_response = llm.predict(relevance_check_prompt)
-        
-        if "GREETING" in relevance_response.upper():
-            greeting_response = llm.predict("Generate a friendly greeting response for a woodworking assistant.")
-            return jsonify({
-                'response': greeting_response,
-                'related_products': [],
-                'url': None,
-                'context': [],
-                'video_links': {}
-            })
-        elif "INAPPROPRIATE" in relevance_response.upper():
-            return jsonify({
-                'response': "I'm sorry, but this is outside my context of answering. Is there something else I can help you with regarding woodworking, tools, or home improvement?",
-                'related_products': [],
-                'url': None,
-                'context': [],
-                'video_links': {}
-            })
-        elif "NOT RELEVANT" in relevance_response.upper():
-            return jsonify({
-                'response': "I'm sorry, but I'm specialized in topics related to our company, woodworking, tools, and home improvement. I can also engage in general conversation or continue our previous discussion. Could you please ask a question related to these topics, continue our previous conversation, or start with a greeting?",
-                'related_products': [],
-                'url': None,
-                'context': [],
-                'video_links': {}
-            })
+        # Identical first-turn questions arriving together share one pipeline run
+        if not formatted_history:
+            key = (normalize_question(user_query), selected_index)
+            (payload, status), shared = chat_flight.do(
+                key, lambda: run_chat_pipeline(user_query, selected_index, formatted_history)
+            )
+            record_cache('singleflight', hit=shared)
+            if shared:
+                set_response_path('cached')
+        else:
+            payload, status = run_chat_pipeline(user_query, selected_index, formatted_history)
 
-        # If we reach here, the query is relevant and not a greeting
-        retriever = transcript_vector_stores[selected_index].as_retriever(search_kwargs={"k": 3})
-        
-        prompt = ChatPromptTemplate.from_messages([
-            SystemMessagePromptTemplate.from_template(SYSTEM_INSTRUCTIONS),
-            HumanMessagePromptTemplate.from_template("Context: {context}\n\nChat History: {chat_history}\n\nQuestion: {question}")
-        ])
-        
-        qa_chain = ConversationalRetrievalChain.from_llm(
-            llm=llm,
-            retriever=retriever,
-            combine_docs_chain_kwargs={"prompt": prompt},
-            return_source_documents=True
-        )
-        
-        try:
-            result = retry_llm_call(qa_chain, user_query, formatted_history)
-        except LLMResponseError as e:
-            error_message = "Failed to get a complete response from the AI after multiple attempts."
-            if isinstance(e, LLMNoResponseError):
-                error_message = "The AI failed to generate a response after multiple attempts."
-            return jsonify({'error': error_message}), 500
-        except Exception as e:
-            logging.error(f"Unexpected error in LLM call: {str(e)}")
-            return jsonify({'error': 'An unexpected error occurred while processing your request.'}), 500
-        
-        initial_answer = result['answer']
-        context = [doc.page_content for doc in result['source_documents']]
-        source_documents = result['source_documents']
-        
-        # Extract video title from metadata of the first source document
-        video_title = "Unknown Video"
-        url = None
-        if source_documents:
-            metadata = source_documents[0].metadata
-            video_title = metadata.get('title', "Unknown Video")
-            url = metadata.get('url', None)
-
-        logging.debug(f"Extracted video title from chunk metadata: {video_title}")
-        # In your chat function, add this logging:
-        logging.debug(f"Video title before get_matched_products: {video_title}")
-        related_products = get_matched_products(video_title)
-        logging.debug(f"Retrieved matched products: {related_products}")
-
-        # Process the answer to replace timestamps and extract video links
-        processed_answer, video_dict = process_answer(initial_answer, url)
-        
-        logging.debug(f"Processed answer: {processed_answer}")
-        
-        # Get matched products based on video title
-        related_products = get_matched_products(video_title)
-
-        logging.debug(f"Retrieved matched products: {related_products}")
-
-        response_data = {
-            'response': processed_answer,
-            'initial_answer': initial_answer,
-            'related_products': related_products,
-            'url': url,
-            'context': context,
-            'video_links': video_dict,
-            'video_title': video_title
-        }
-
-        return jsonify(response_data)
+        if status != 200:
+            set_response_path('error')
+            return jsonify(payload), status
+
+        if conversation_id is not None:
+            append_conversation_turn(
+                conversation_id, selected_index, user_query, payload.get('initial_answer', payload['response'])
+            )
+            if needs_compaction:
+                schedule_compaction(conversation_id)
+            payload = {**payload, 'conversation_id': conversation_id}
+        return chat_response(payload)
     except Exception as e:
         logging.error(f"Error in chat route: {str(e)}", exc_info=True)
         return jsonify({'error': 'An error occurred processing your request'}), 500
@@ -409,26 +1165,93 @@ def upload_document():
     
     if file and file.filename.endswith('.docx'):
         filename = secure_filename(file.filename)
-        file_path = os.path.join('/tmp', filename)
+        # Unique name so concurrent uploads of the same file don't clobber each other
+        file_path = os.path.join('/tmp', f"{uuid.uuid4().hex}_{filename}")
         file.save(file_path)
         
-        transcript_text = extract_text_from_docx(file_path)
-        metadata = extract_metadata_from_text(transcript_text)
-        upsert_transcript(transcript_text, metadata, index_name)
-        
-        os.remove(file_path)
-        return jsonify({'success': True, 'message': 'File uploaded and processed successfully'})
+        # Under serve.py processing continues after the 202 on a background thread; elsewhere
+        # it runs inline and the response reports the outcome
+        try:
+            job_id = upload_jobs.submit(process_upload, file_path, index_name)
+        except Exception as e:
+            logging.error(f"Error queueing upload: {str(e)}", exc_info=True)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            return jsonify({'success': False, 'message': 'Could not queue the upload'}), 500
+        if upload_jobs.inline:
+            job = upload_jobs.get(job_id)
+            if job is None or job['status'] != 'succeeded':
+                return jsonify({'success': False, 'message': 'Error processing the file', 'job_id': job_id}), 500
+            return jsonify({'success': True, 'message': 'File uploaded and processed successfully', 'job_id': job_id})
+        return jsonify({
+            'success': True,
+            'message': 'File uploaded and queued for processing',
+            'job_id': job_id,
+            'status_url': url_for('upload_status', job_id=job_id, _external=True)
+        }), 202
     else:
         return jsonify({'success': False, 'message': 'Invalid file format'})
 
+@app.route('/upload_status/<job_id>')
+def upload_status(job_id):
+    try:
+        job = upload_jobs.get(job_id)
+    except Exception as e:
+        logging.error(f"Error fetching upload status: {str(e)}", exc_info=True)
+        return jsonify({'error': 'Could not fetch job status'}), 500
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/product_image/<image_hash>')
+def product_image(image_hash):
+    if not re.fullmatch(r'[0-9a-f]{64}', image_hash):
+        return jsonify({"error": "Image not found"}), 404
+    try:
+        if request.if_none_match.contains(image_hash):
+            return image_response(image_hash, b'', 'application/octet-stream')
+        image_data = fetch_product_image(image_hash)
+        if image_data is None:
+            return jsonify({"error": "Image not found"}), 404
+        img_format = Image.open(BytesIO(image_data)).format
+        return image_response(image_hash, image_data, Image.MIME.get(img_format, 'application/octet-stream'))
+    except Exception as e:
+        logging.error(f"Error in product_image: {str(e)}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/product_image/<image_hash>/thumbnail')
+def product_thumbnail(image_hash):
+    if not re.fullmatch(r'[0-9a-f]{64}', image_hash):
+        return jsonify({"error": "Image not found"}), 404
+    try:
+        if request.if_none_match.contains(image_hash):
+            return image_response(image_hash, b'', 'image/jpeg')
+        CACHE_LOOKUPS.labels('thumbnail').inc()
+        thumbnail = make_thumbnail(image_hash)
+        if thumbnail is None:
+            return jsonify({"error": "Image not found"}), 404
+        return image_response(image_hash, thumbnail, 'image/jpeg')
+    except Exception as e:
+        logging.error(f"Error in product_thumbnail: {str(e)}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/documents')
 def get_documents():
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT * FROM products")
-            documents = cur.fetchall()
-        conn.close()
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                tag = request.args.get('tag')
+                # Image bytes are served by /product_image, not inlined here
+                columns = "id, title, tags, tag_list, link, image_hash"
+                if tag:
+                    # Exact tag lookup, served by the products_tag_list_idx GIN index
+                    cur.execute(f"SELECT {columns} FROM products WHERE tag_list @> ARRAY[%s]", (tag,))
+                else:
+                    cur.execute(f"SELECT {columns} FROM products")
+                documents = cur.fetchall()
+        for document in documents:
+            document['image_url'] = product_image_url(document['image_hash'])
+            document['thumbnail_url'] = product_image_url(document['image_hash'], thumbnail=True)
         return jsonify(documents)
     except Exception as e:
         print(f"Error in get_documents: {str(e)}")
@@ -438,15 +1261,14 @@ def get_documents():
 def add_document():
     data = request.json
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                "INSERT INTO products (title, tags, link) VALUES (%s, %s, %s) RETURNING id",
-                (data['title'], ','.join(data['tags']), data['link'])
-            )
-            product_id = cur.fetchone()['id']
-        conn.commit()
-        conn.close()
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    "INSERT INTO products (title, tags, link) VALUES (%s, %s, %s) RETURNING id",
+                    (data['title'], ','.join(data['tags']), data['link'])
+                )
+                product_id = cur.fetchone()['id']
+            conn.commit()
         return jsonify({'success': True, 'product_id': product_id})
     except Exception as e:
         print(f"Error in add_document: {str(e)}")
@@ -456,11 +1278,10 @@ def add_document():
 def delete_document():
     data = request.json
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor() as cur:
-            cur.execute("DELETE FROM products WHERE id = %s", (data['id'],))
-        conn.commit()
-        conn.close()
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM products WHERE id = %s", (data['id'],))
+            conn.commit()
         return jsonify({'success': True})
     except Exception as e:
         print(f"Error in delete_document: {str(e)}")
@@ -470,23 +1291,26 @@ def delete_document():
 def update_document():
     data = request.json
     try:
-        conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
-        with conn.cursor() as cur:
-            cur.execute(
-                "UPDATE products SET title = %s, tags = %s, link = %s WHERE id = %s",
-                (data['title'], ','.join(data['tags']), data['link'], data['id'])
-            )
-        conn.commit()
-        conn.close()
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE products SET title = %s, tags = %s, link = %s WHERE id = %s",
+                    (data['title'], ','.join(data['tags']), data['link'], data['id'])
+                )
+            conn.commit()
         return jsonify({'success': True})
     except Exception as e:
         print(f"Error in update_document: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2), retry=retry_if_exception_type(LLMResponseError))
+def count_llm_retry(retry_state):
+    LLM_RETRIES.labels(type(retry_state.outcome.exception()).__name__).inc()
+
+@retry(stop=stop_after_attempt(3), wait=wait_fixed(2), retry=retry_if_exception_type(LLMResponseError),
+       before_sleep=count_llm_retry)
 def retry_llm_call(qa_chain, query, chat_history):
     try:
-        result = qa_chain({"question": query, "chat_history": chat_history})
+        result = qa_chain({"question": query, "chat_history": chat_history}, callbacks=[metrics_handler])
         
         if result is None or 'answer' not in result or not result['answer']:
             raise LLMNoResponseError("LLM failed to generate a response")
@@ -503,5 +1327,6 @@ def retry_llm_call(qa_chain, query, chat_history):
         raise LLMNoResponseError("LLM failed due to an unexpected error")
 
 if __name__ == '__main__':
+    # Development server only; use serve.py in production
     verify_database()
-    app.run(debug=True, port=5000)
+    app.run(debug=os.getenv("FLASK_DEBUG") == "1", port=5000)
@@ -0,0 +1,130 @@
+"""Micro-batch concurrent query embeddings into one embeddings API call.
+
+Each /chat embeds its question with its own embed_query call. EmbeddingBatcher
+holds the first query for up to `max_wait` seconds so queries from concurrent
+requests can join it, then embeds the whole batch with one embed_documents call
+and hands each caller its vector. Identical texts in a batch are embedded once.
+Up to `max_in_flight` batches are sent concurrently, so a query arriving while a
+batch is in flight does not wait for that call to return.
+"""
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.embeddings import Embeddings
+
+
+class _Request:
+    def __init__(self, text):
+        self.text = text
+        self.enqueued_at = time.monotonic()
+        self.done = threading.Event()
+        self.vector = None
+        self.error = None
+
+
+class EmbeddingBatcher(Embeddings):
+    """Embeddings wrapper that batches embed_query across threads.
+
+    embed_documents passes straight through; callers of it (uploads) already
+    batch. A max_wait of 0 disables batching.
+    """
+
+    def __init__(self, embeddings, max_batch_size=64, max_wait=0.005, max_in_flight=4, timeout=30, on_batch=None):
+        self.embeddings = embeddings
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_in_flight = max_in_flight
+        # Longest a caller waits for its batch before giving up
+        self.timeout = timeout
+        # on_batch(batch_size, queue_depth) is called for every batch sent
+        self.on_batch = on_batch
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._pending = []
+        self._thread = None
+        self._executor = None
+        self._slots = None
+        self._pid = None
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        if self.max_wait <= 0:
+            return self.embeddings.embed_query(text)
+        request = _Request(text)
+        with self._lock:
+            self._ensure_worker()
+            self._pending.append(request)
+            self._wakeup.notify()
+        if not request.done.wait(self.timeout):
+            raise TimeoutError(f"Query embedding did not complete within {self.timeout}s")
+        if request.error is not None:
+            raise request.error
+        return request.vector
+
+    def queue_depth(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _ensure_worker(self):
+        # Called with the lock held. Threads do not survive fork, so each worker process
+        # starts its own; a dispatcher that died is replaced and picks up what is queued.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pending = []
+            self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='embed-batch')
+            self._slots = threading.BoundedSemaphore(self.max_in_flight)
+            self._thread = None
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='embed-batcher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._wakeup.wait()
+                # Give concurrent queries until the oldest one's deadline to join
+                deadline = self._pending[0].enqueued_at + self.max_wait
+                while len(self._pending) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._wakeup.wait(remaining)
+            # With every slot busy, queries keep joining the next batch until one frees up
+            self._slots.acquire()
+            with self._lock:
+                depth = len(self._pending)
+                batch = self._pending[:self.max_batch_size]
+                del self._pending[:self.max_batch_size]
+            try:
+                self._executor.submit(self._dispatch, batch, depth)
+            except Exception as e:
+                self._slots.release()
+                self._fail(batch, e)
+
+    def _fail(self, batch, error):
+        for request in batch:
+            request.error = error
+            request.done.set()
+
+    def _dispatch(self, batch, depth):
+        texts = list(dict.fromkeys(request.text for request in batch))
+        try:
+            vectors = dict(zip(texts, self.embeddings.embed_documents(texts)))
+            for request in batch:
+                request.vector = vectors[request.text]
+                request.done.set()
+        except Exception as e:
+            logging.error(f"Batched embedding of {len(texts)} queries failed: {str(e)}", exc_info=True)
+            self._fail(batch, e)
+        finally:
+            self._slots.release()
+        if self.on_batch is not None:
+            try:
+                self.on_batch(len(texts), depth)
+            except Exception as e:
+                logging.error(f"Embedding batch callback failed: {str(e)}", exc_info=True)
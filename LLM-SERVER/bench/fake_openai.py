@@ -0,0 +1,164 @@
+"""Local stand-in for the OpenAI chat completions and embeddings APIs.
+
+Answers with canned text after a configurable delay, so the app can be
+benchmarked without paying for (or waiting on) the real service. Embeddings are
+deterministic feature-hashed bag-of-words vectors, so similar texts still land
+near each other in the vector store.
+
+Usage:
+    python bench/fake_openai.py --port 8100 --chat-latency-ms 400 --embed-latency-ms 60
+    OPENAI_API_BASE=http://127.0.0.1:8100/v1 python app.py
+"""
+import re
+import json
+import math
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EMBEDDING_DIMENSION = 1536
+
+ANSWER = (
+    "Jason Bent covers this in the video. He explains that a good setup starts with "
+    "the basics and walks through each step around {timestamp:01:23}, then returns to "
+    "the details in the vicinity of {timestamp:04:56}."
+)
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def feature_hash(items):
+    vector = [0.0] * EMBEDDING_DIMENSION
+    for item in items:
+        digest = hashlib.blake2b(str(item).encode(), digest_size=8).digest()
+        value = int.from_bytes(digest, 'little')
+        vector[value % EMBEDDING_DIMENSION] += 1.0 if value & (1 << 63) else -1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+def embed(item):
+    # langchain sends token id lists when check_embedding_ctx_length is on
+    if isinstance(item, list):
+        return feature_hash(item), len(item)
+    words = re.findall(r'\w+', item.lower())
+    return feature_hash(words), estimate_tokens(item)
+
+
+def chat_reply(messages):
+    prompt = "\n".join(str(m.get('content', '')) for m in messages)
+    if 'GREETING, RELEVANT' in prompt:
+        if 'STANDALONE:' in prompt:
+            question = re.findall(r'Current Question:\s*(.*)', prompt)
+            return f"RELEVANT\nSTANDALONE: {question[-1].strip() if question else ''}"
+        return 'RELEVANT'
+    if 'standalone question' in prompt:
+        question = re.findall(r'Follow Up Input:\s*(.*)', prompt)
+        return question[-1].strip() if question else prompt.strip().splitlines()[-1]
+    if 'friendly greeting' in prompt:
+        return "Hello! I'm here to help with all your woodworking questions."
+    return ANSWER
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    config = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _sleep(self, latency_ms):
+        jitter = random.uniform(-self.config.jitter_ms, self.config.jitter_ms)
+        time.sleep(max(0.0, latency_ms + jitter) / 1000)
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        with self.config.lock:
+            self.config.calls[self.path] = self.config.calls.get(self.path, 0) + 1
+
+        if self.path.endswith('/embeddings'):
+            inputs = request.get('input', [])
+            if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+                inputs = [inputs]
+            self._sleep(self.config.embed_latency_ms)
+            data, tokens = [], 0
+            for i, item in enumerate(inputs):
+                vector, n = embed(item)
+                tokens += n
+                data.append({'object': 'embedding', 'index': i, 'embedding': vector})
+            self._send_json(200, {
+                'object': 'list', 'data': data, 'model': request.get('model'),
+                'usage': {'prompt_tokens': tokens, 'total_tokens': tokens}
+            })
+        elif self.path.endswith('/chat/completions'):
+            messages = request.get('messages', [])
+            content = chat_reply(messages)
+            self._sleep(self.config.chat_latency_ms)
+            prompt_tokens = sum(estimate_tokens(str(m.get('content', ''))) for m in messages)
+            completion_tokens = estimate_tokens(content)
+            self._send_json(200, {
+                'id': f'chatcmpl-{random.getrandbits(64):x}',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': request.get('model'),
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': content},
+                    'finish_reason': 'stop',
+                    'logprobs': None
+                }],
+                'usage': {
+                    'prompt_tokens': prompt_tokens,
+                    'completion_tokens': completion_tokens,
+                    'total_tokens': prompt_tokens + completion_tokens
+                }
+            })
+        else:
+            self._send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+
+
+def start_server(port=0, chat_latency_ms=400, embed_latency_ms=60, jitter_ms=20):
+    """Start the fake API on a background thread and return the server.
+
+    `server.config.calls` counts requests per path, which shows how many
+    upstream calls a benchmark run made.
+    """
+    config = argparse.Namespace(
+        chat_latency_ms=chat_latency_ms, embed_latency_ms=embed_latency_ms,
+        jitter_ms=jitter_ms, calls={}, lock=threading.Lock()
+    )
+    handler = type('ConfiguredHandler', (FakeOpenAIHandler,), {'config': config})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    server.config = config
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--chat-latency-ms', type=float, default=400)
+    parser.add_argument('--embed-latency-ms', type=float, default=60)
+    parser.add_argument('--jitter-ms', type=float, default=20)
+    args = parser.parse_args()
+    server = start_server(args.port, args.chat_latency_ms, args.embed_latency_ms, args.jitter_ms)
+    print(f"Fake OpenAI API listening on http://127.0.0.1:{server.server_address[1]}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,479 @@
+"""Offline load test for the Flask app.
+
+Starts the fake OpenAI API (bench/fake_openai.py), launches the app against it
+with the in-memory vector store, seeds transcripts through /upload_document,
+then drives concurrent load and prints a JSON report: RPS, latency percentiles,
+and a per-stage breakdown scraped from /metrics.
+
+Usage:
+    python bench/loadtest.py --scenario chat --concurrency 8 --requests 200
+    python bench/loadtest.py --scenario upload --concurrency 2 --requests 20 --output upload.json
+
+Product lookups and server-side conversation history need Postgres. Pass
+--postgres-url pointing at a scratch database; the products table is created,
+migrated and seeded if it is empty. Without it, a throwaway local server is
+started if the Postgres binaries (initdb, pg_ctl) are installed. Failing that
+the app runs without a database, and the report lists the history and products
+stages under "absent_stages".
+"""
+import os
+import re
+import sys
+import glob
+import json
+import time
+import uuid
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+from docx import Document
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, SERVER_DIR)
+
+from fake_openai import start_server
+
+SEED_TITLES = [
+    "2020 Shop Tour",
+    "Complete Mr Cool Install",
+    "10 Tools Every Woodworker Should Own",
+    "The biggest advancement in dust collection",
+    "Assembly Table and Miter Saw Station",
+]
+
+QUESTIONS = [
+    "What are the 10 most recommended woodworking tools?",
+    "Suggest me some shop layout tips?",
+    "What are the benefits of LR32 system for cabinetry?",
+    "How did Jason install the Mr Cool mini split?",
+    "What dust collector does Jason use?",
+    "How is the miter saw station built?",
+]
+
+STAGE_METRIC = 'bents_stage_latency_seconds'
+METRICS_TOKEN = uuid.uuid4().hex  # the app under test only serves /metrics with this token
+TOKEN_METRIC = 'bents_llm_tokens_total'
+# Stages that only run with a database
+DATABASE_STAGES = ['history', 'products']
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+def make_transcript(title, paragraphs=40):
+    doc = Document()
+    doc.add_paragraph(title)
+    for i in range(paragraphs):
+        minutes, seconds = divmod(i * 37, 60)
+        doc.add_paragraph(
+            f"[Timestamp: 00:{minutes:02d}:{seconds:02d}] In {title} Jason talks about the shop, "
+            f"the tools he relies on, dust collection, cabinetry and the layout decisions behind part {i}."
+        )
+    out = BytesIO()
+    doc.save(out)
+    return out.getvalue()
+
+
+def encode_multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    body = BytesIO()
+    for name, value in fields.items():
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, content) in files.items():
+        body.write(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'.encode()
+        )
+        body.write(content)
+        body.write(b'\r\n')
+    body.write(f'--{boundary}--\r\n'.encode())
+    return body.getvalue(), f'multipart/form-data; boundary={boundary}'
+
+
+def http_request(url, data=None, content_type='application/json', timeout=120, headers=None):
+    headers = dict(headers or {})
+    if data is not None:
+        headers['Content-Type'] = content_type
+    req = urllib.request.Request(url, data=data, headers=headers)
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return resp.status, resp.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def upload_request(base_url, title, index_name='bents'):
+    body, content_type = encode_multipart(
+        {'index_name': index_name},
+        {'file': (f'{re.sub(r"[^A-Za-z0-9]+", "_", title)}.docx', make_transcript(title))}
+    )
+    return http_request(f'{base_url}/upload_document', body, content_type)
+
+
+def wait_for_job(status_url, timeout=120, interval=0.2):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status, body = http_request(status_url)
+        job = json.loads(body) if status == 200 else {}
+        if job.get('status') in ('succeeded', 'failed'):
+            return job
+        time.sleep(interval)
+    raise RuntimeError(f"Upload job {status_url} did not finish within {timeout}s")
+
+
+def scenario_request(args, base_url, n):
+    if args.scenario == 'chat':
+        history = []
+        for turn in range(args.history_turns):
+            history += [QUESTIONS[turn % len(QUESTIONS)], "Earlier answer from Jason about the shop."]
+        payload = {
+            'message': QUESTIONS[n % len(QUESTIONS)],
+            'selected_index': args.index,
+            'chat_history': history,
+        }
+        return http_request(f'{base_url}/chat', json.dumps(payload).encode())
+    if args.scenario == 'upload':
+        # Measure end-to-end ingestion, not just queueing: wait for the job behind the 202
+        status, body = upload_request(base_url, f'{SEED_TITLES[n % len(SEED_TITLES)]} {n}', args.index)
+        if status != 202:
+            return status, body
+        try:
+            job = wait_for_job(json.loads(body)['status_url'], interval=0.02)
+        except RuntimeError:
+            return 'job_timeout', body
+        return (200 if job['status'] == 'succeeded' else 'job_failed'), body
+    if args.scenario == 'products':
+        return http_request(f'{base_url}/documents')
+    raise ValueError(f"Unknown scenario {args.scenario}")
+
+
+def parse_metrics(text):
+    """Parse Prometheus text exposition into {(name, frozenset(labels)): value}."""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        match = re.match(r'([a-zA-Z_:][\w:]*)(?:\{(.*)\})?\s+(\S+)', line)
+        if not match:
+            continue
+        name, labels, value = match.groups()
+        label_pairs = frozenset(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', labels or ''))
+        samples[(name, label_pairs)] = float(value)
+    return samples
+
+
+def scrape_metrics(base_url):
+    status, body = http_request(f'{base_url}/metrics', headers={'Authorization': f'Bearer {METRICS_TOKEN}'})
+    return parse_metrics(body.decode()) if status == 200 else {}
+
+
+def bucket_quantile(buckets, q):
+    """Estimate a quantile from cumulative (upper_bound, count) histogram buckets."""
+    buckets = sorted(buckets)
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return None
+    target = q * total
+    prev_bound, prev_count = 0.0, 0.0
+    for bound, count in buckets:
+        if count >= target:
+            if bound == float('inf'):
+                return prev_bound
+            width = count - prev_count
+            return prev_bound + (bound - prev_bound) * ((target - prev_count) / width if width else 0)
+        prev_bound, prev_count = bound, count
+    return prev_bound
+
+
+def stage_breakdown(before, after):
+    def delta(key):
+        return after.get(key, 0.0) - before.get(key, 0.0)
+
+    stages = {}
+    for (name, labels) in after:
+        if name == f'{STAGE_METRIC}_count':
+            stage = dict(labels)['stage']
+            count = delta((name, labels))
+            if count <= 0:
+                continue
+            total = delta((f'{STAGE_METRIC}_sum', labels))
+            buckets = [
+                (float(dict(l)['le']), delta((n, l)))
+                for (n, l) in after
+                if n == f'{STAGE_METRIC}_bucket' and dict(l).get('stage') == stage
+            ]
+            p95 = bucket_quantile(buckets, 0.95)
+            stages[stage] = {
+                'count': int(count),
+                'mean_ms': round(total / count * 1000, 2),
+                'p95_ms': round(p95 * 1000, 2) if p95 is not None else None,
+            }
+
+    tokens = {}
+    for (name, labels) in after:
+        if name == TOKEN_METRIC:
+            label_dict = dict(labels)
+            value = delta((name, labels))
+            if value:
+                tokens.setdefault(label_dict['stage'], {})[label_dict['kind']] = int(value)
+    return stages, tokens
+
+
+def prepare_postgres(postgres_url):
+    import psycopg2
+    import migrate
+
+    os.environ['POSTGRES_URL'] = postgres_url
+    conn = psycopg2.connect(postgres_url)
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS products (
+                id SERIAL PRIMARY KEY,
+                title TEXT,
+                tags TEXT,
+                link TEXT,
+                image_data BYTEA
+            )
+        """)
+    conn.commit()
+    migrate.migrate()
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM products")
+        if cur.fetchone()[0] == 0:
+            for i, title in enumerate(SEED_TITLES * 20):
+                cur.execute(
+                    "INSERT INTO products (title, tags, link) VALUES (%s, %s, %s)",
+                    (f'Bench product {i}', f'{title},bench,tool {i}', f'https://example.com/p/{i}')
+                )
+    conn.commit()
+    conn.close()
+
+
+def find_postgres_bin():
+    initdb = shutil.which('initdb')
+    if initdb and shutil.which('pg_ctl'):
+        return os.path.dirname(initdb)
+    for bin_dir in sorted(glob.glob('/usr/lib/postgresql/*/bin'), reverse=True):
+        if os.path.exists(os.path.join(bin_dir, 'initdb')):
+            return bin_dir
+    return None
+
+
+def start_local_postgres():
+    """Start a throwaway Postgres in a temp dir; returns (url, stop) or None if unavailable."""
+    bin_dir = find_postgres_bin()
+    if bin_dir is None:
+        return None
+    data_dir = tempfile.mkdtemp(prefix='bents-bench-pg-')
+    port = free_port()
+    try:
+        subprocess.run(
+            [os.path.join(bin_dir, 'initdb'), '-D', data_dir, '-U', 'bench', '--auth', 'trust'],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        subprocess.run(
+            [os.path.join(bin_dir, 'pg_ctl'), '-D', data_dir, '-w', '-l', os.path.join(data_dir, 'server.log'),
+             '-o', f'-p {port} -k {data_dir} -c listen_addresses=127.0.0.1', 'start'],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+    except (OSError, subprocess.CalledProcessError):
+        # e.g. initdb refuses to run as root
+        shutil.rmtree(data_dir, ignore_errors=True)
+        return None
+
+    def stop():
+        subprocess.run([os.path.join(bin_dir, 'pg_ctl'), '-D', data_dir, '-m', 'fast', 'stop'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    return f'postgresql://bench@127.0.0.1:{port}/postgres', stop
+
+
+def wait_until_ready(base_url, proc, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"App exited during startup with code {proc.returncode}")
+        try:
+            status, _ = http_request(f'{base_url}/ready', timeout=2)
+            if status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"App did not become ready within {timeout}s")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=SERVER_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_load(args, base_url):
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+    counter = iter(range(args.requests))
+    deadline = time.time() + args.duration if args.duration else None
+
+    def worker():
+        for n in counter:
+            if deadline and time.time() > deadline:
+                return
+            start = time.perf_counter()
+            try:
+                status, _ = scenario_request(args, base_url, n)
+            except OSError:
+                status = 'connection_error'
+            with lock:
+                latencies.append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for _ in range(args.concurrency):
+            pool.submit(worker)
+    elapsed = time.perf_counter() - start
+    return latencies, statuses, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', choices=['chat', 'upload', 'products'], default='chat')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=None, help='stop after this many seconds')
+    parser.add_argument('--index', default='bents')
+    parser.add_argument('--history-turns', type=int, default=0, help='chat_history turns sent with each chat')
+    parser.add_argument('--seed-transcripts', type=int, default=len(SEED_TITLES))
+    parser.add_argument('--chat-latency-ms', type=float, default=400)
+    parser.add_argument('--embed-latency-ms', type=float, default=60)
+    parser.add_argument('--jitter-ms', type=float, default=20)
+    parser.add_argument('--postgres-url', default=os.getenv('BENCH_POSTGRES_URL'))
+    parser.add_argument('--server-cmd', default=None,
+                        help='command that starts the app; {port} is substituted (default: serve.py, one worker)')
+    parser.add_argument('--startup-timeout', type=float, default=60)
+    parser.add_argument('--output', default=None, help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    fake = start_server(0, args.chat_latency_ms, args.embed_latency_ms, args.jitter_ms)
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+
+    env = dict(os.environ)
+    env.update({
+        'OPENAI_API_BASE': f'http://127.0.0.1:{fake.server_address[1]}/v1',
+        'OPENAI_API_KEY': 'bench',
+        'VECTOR_STORE_BACKEND': 'memory',
+        'LANGCHAIN_TRACING_V2': 'false',
+    })
+    env['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='bents-bench-metrics-')
+    env['METRICS_TOKEN'] = METRICS_TOKEN
+    postgres, stop_postgres = 'external' if args.postgres_url else None, None
+    if not args.postgres_url:
+        local = start_local_postgres()
+        if local is not None:
+            args.postgres_url, stop_postgres = local
+            postgres = 'throwaway'
+    if args.postgres_url:
+        prepare_postgres(args.postgres_url)
+        env['POSTGRES_URL'] = args.postgres_url
+    else:
+        # The app skips product lookups and server-side history without a database
+        env.pop('POSTGRES_URL', None)
+
+    if args.server_cmd:
+        cmd = args.server_cmd.format(port=port).split()
+    else:
+        # One worker: the in-memory vector store and upload jobs are per process
+        cmd = [sys.executable, 'serve.py', '--host', '127.0.0.1', '--port', str(port), '--workers', '1']
+    proc = subprocess.Popen(cmd, cwd=SERVER_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_ready(base_url, proc, args.startup_timeout)
+        # Uploads are processed in the background; wait for seeding to finish
+        seed_jobs = []
+        for i in range(args.seed_transcripts):
+            status, body = upload_request(base_url, SEED_TITLES[i % len(SEED_TITLES)], args.index)
+            if status == 202:
+                seed_jobs.append(json.loads(body)['status_url'])
+        for status_url in seed_jobs:
+            wait_for_job(status_url)
+
+        calls_before = dict(fake.config.calls)
+        before = scrape_metrics(base_url)
+        latencies, statuses, elapsed = run_load(args, base_url)
+        after = scrape_metrics(base_url)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+        fake.shutdown()
+        if stop_postgres is not None:
+            stop_postgres()
+
+    latencies.sort()
+    stages, tokens = stage_breakdown(before, after)
+    errors = sum(count for status, count in statuses.items() if not (isinstance(status, int) and 200 <= status < 300))
+    report = {
+        'commit': git_commit(),
+        'scenario': args.scenario,
+        'concurrency': args.concurrency,
+        'requests': len(latencies),
+        'errors': errors,
+        'statuses': {str(k): v for k, v in statuses.items()},
+        'duration_s': round(elapsed, 3),
+        'rps': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies) * 1000, 2) if latencies else None,
+            'p50': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+            'p95': round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+            'p99': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+            'max': round(latencies[-1] * 1000, 2) if latencies else None,
+        },
+        'stages': stages,
+        'absent_stages': [] if postgres else DATABASE_STAGES,
+        'tokens': tokens,
+        'upstream_calls': {
+            path: count - calls_before.get(path, 0) for path, count in fake.config.calls.items()
+        },
+        'config': {
+            'chat_latency_ms': args.chat_latency_ms,
+            'embed_latency_ms': args.embed_latency_ms,
+            'jitter_ms': args.jitter_ms,
+            'history_turns': args.history_turns,
+            'postgres': postgres,
+        },
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
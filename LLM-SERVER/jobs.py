@@ -0,0 +1,188 @@
+"""Background job queue with bounded concurrency and pluggable job state.
+
+Jobs run on a thread pool in the process that accepted them. Their status and
+progress live in a store: MemoryJobStore keeps them in that process only, so
+status must be polled against the same process; PostgresJobStore keeps them in
+the jobs table (migrations/0005_jobs.sql), so any worker or instance can answer
+a status poll.
+
+Background jobs need a long-running process: on serverless platforms the
+thread may be frozen once the response is sent. There, create the queue with
+inline=True so submit() runs the job to completion in the calling request.
+PostgresJobStore also reports a job as failed after `stale_after` seconds
+without progress instead of leaving it running forever.
+"""
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+
+class MemoryJobStore:
+    def __init__(self, keep=500):
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._keep = keep
+
+    def create(self, job_id):
+        now = time.time()
+        with self._lock:
+            self._jobs[job_id] = {
+                'id': job_id,
+                'status': 'queued',
+                'progress': {},
+                'error': None,
+                'created_at': now,
+                'updated_at': now,
+            }
+            # Forget the oldest finished jobs once over the retention limit
+            while len(self._jobs) > self._keep:
+                oldest_id, oldest = next(iter(self._jobs.items()))
+                if oldest['status'] in ACTIVE_STATUSES:
+                    break
+                del self._jobs[oldest_id]
+
+    def update(self, job_id, status, error=None):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(status=status, error=error, updated_at=time.time())
+
+    def add_progress(self, job_id, progress):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job['progress'].update(progress)
+                job['updated_at'] = time.time()
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return None if job is None else {**job, 'progress': dict(job['progress'])}
+
+    def pending(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job['status'] in ACTIVE_STATUSES)
+
+
+class PostgresJobStore:
+    """Job state in the jobs table. `connection` is a context manager factory
+    yielding a psycopg2 connection (app.db_connection)."""
+
+    def __init__(self, connection, kind, keep_days=7, stale_after=900):
+        self.connection = connection
+        self.kind = kind
+        self.keep_days = keep_days
+        self.stale_after = stale_after
+
+    def _execute(self, query, params):
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+                rows = cur.fetchall() if cur.description else None
+            conn.commit()
+        return rows
+
+    def create(self, job_id):
+        self._execute(
+            "INSERT INTO jobs (id, kind, status) VALUES (%s, %s, 'queued')",
+            (job_id, self.kind)
+        )
+        self._execute(
+            """
+            DELETE FROM jobs
+            WHERE kind = %s AND status NOT IN %s AND updated_at < NOW() - make_interval(days => %s)
+            """,
+            (self.kind, ACTIVE_STATUSES, self.keep_days)
+        )
+
+    def update(self, job_id, status, error=None):
+        self._execute(
+            "UPDATE jobs SET status = %s, error = %s, updated_at = NOW() WHERE id = %s",
+            (status, error, job_id)
+        )
+
+    def add_progress(self, job_id, progress):
+        self._execute(
+            "UPDATE jobs SET progress = progress || %s::jsonb, updated_at = NOW() WHERE id = %s",
+            (json.dumps(progress), job_id)
+        )
+
+    def get(self, job_id):
+        rows = self._execute(
+            """
+            SELECT id, status, progress, error,
+                   EXTRACT(EPOCH FROM created_at), EXTRACT(EPOCH FROM updated_at)
+            FROM jobs WHERE id = %s AND kind = %s
+            """,
+            (job_id, self.kind)
+        )
+        if not rows:
+            return None
+        job_id, status, progress, error, created_at, updated_at = rows[0]
+        job = {
+            'id': job_id,
+            'status': status,
+            'progress': progress,
+            'error': error,
+            'created_at': float(created_at),
+            'updated_at': float(updated_at),
+        }
+        # The process running it went away (restart, serverless freeze)
+        if status in ACTIVE_STATUSES and time.time() - job['updated_at'] > self.stale_after:
+            job.update(status='failed', error='Job stopped reporting progress')
+        return job
+
+    def pending(self):
+        rows = self._execute(
+            "SELECT COUNT(*) FROM jobs WHERE kind = %s AND status IN %s",
+            (self.kind, ACTIVE_STATUSES)
+        )
+        return rows[0][0]
+
+
+class JobQueue:
+    def __init__(self, max_workers=2, keep=500, name='job', store=None, inline=False):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'{name}-worker')
+        self._store = store if store is not None else MemoryJobStore(keep)
+        self.inline = inline
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(report, *args, **kwargs) and return its job id.
+
+        fn receives a `report(**progress)` callback for publishing progress.
+        With inline=True the job has finished by the time this returns.
+        """
+        job_id = uuid.uuid4().hex
+        self._store.create(job_id)
+        if self.inline:
+            self._run(job_id, fn, args, kwargs)
+        else:
+            self._executor.submit(self._run, job_id, fn, args, kwargs)
+        return job_id
+
+    def _run(self, job_id, fn, args, kwargs):
+        def report(**progress):
+            self._store.add_progress(job_id, progress)
+
+        try:
+            self._store.update(job_id, 'running')
+            fn(report, *args, **kwargs)
+            self._store.update(job_id, 'succeeded')
+        except Exception as e:
+            logging.error(f"Job {job_id} failed: {str(e)}", exc_info=True)
+            try:
+                self._store.update(job_id, 'failed', error=str(e))
+            except Exception as store_error:
+                logging.error(f"Could not record failure of job {job_id}: {str(store_error)}")
+
+    def get(self, job_id):
+        return self._store.get(job_id)
+
+    def pending(self):
+        return self._store.pending()
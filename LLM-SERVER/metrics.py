@@ -0,0 +1,330 @@
+"""Prometheus instrumentation for the chat pipeline.
+
+Stages timed explicitly use `stage_timer`; LLM and retriever runs are timed by
+`StageMetricsHandler`, which reads the stage name from a `stage:<name>` run tag.
+Each stage has one source, so a tagged LLM call must not also sit inside a
+`stage_timer` block. Tag the model itself (not an enclosing chain): langchain
+does not pass a chain's own tags down to its child runs.
+
+Token accounting: a request opens a `TokenUsage` with `begin_token_usage`, every
+LLM call made while it is current adds its token counts to it, and
+`record_token_usage` folds the total into counters labelled by index and response
+path. Background tasks use `record_background_usage`, which keeps their tokens out
+of the chat request counters. `usage_report` summarises both for the /usage endpoint.
+"""
+import os
+import time
+import logging
+import contextvars
+from contextlib import contextmanager
+from prometheus_client import (
+    CollectorRegistry, Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST, REGISTRY
+)
+from prometheus_client import multiprocess
+from langchain_core.callbacks import BaseCallbackHandler
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+REQUEST_LATENCY = Histogram(
+    'bents_request_latency_seconds', 'HTTP request latency by endpoint',
+    ['endpoint', 'method', 'status'], buckets=LATENCY_BUCKETS
+)
+STAGE_LATENCY = Histogram(
+    'bents_stage_latency_seconds', 'Latency of each chat pipeline stage',
+    ['stage'], buckets=LATENCY_BUCKETS
+)
+STAGE_ERRORS = Counter(
+    'bents_stage_errors_total', 'Chat pipeline stages that raised', ['stage']
+)
+LLM_RETRIES = Counter(
+    'bents_llm_retries_total', 'QA chain retries made by retry_llm_call', ['reason']
+)
+LLM_TOKENS = Counter(
+    'bents_llm_tokens_total', 'Tokens reported by the OpenAI API', ['stage', 'kind']
+)
+TITLE_ROUTES = Counter(
+    'bents_title_routes_total', 'Retrievals by title-routing outcome (matched, fallback, unmatched)', ['result']
+)
+CACHE_LOOKUPS = Counter(
+    'bents_cache_lookups_total', 'Lookups against in-process caches', ['cache']
+)
+CACHE_MISSES = Counter(
+    'bents_cache_misses_total', 'Lookups that missed in-process caches', ['cache']
+)
+CHAT_REQUESTS = Counter(
+    'bents_chat_requests_total', 'Chat requests by index and response path', ['index', 'path']
+)
+CHAT_TOKENS = Counter(
+    'bents_chat_tokens_total', 'Tokens spent on chat requests', ['index', 'path', 'stage', 'kind']
+)
+CHAT_COST = Counter(
+    'bents_chat_cost_usd_total', 'Estimated OpenAI spend on chat requests', ['index', 'path']
+)
+BACKGROUND_TOKENS = Counter(
+    'bents_background_tokens_total', 'Tokens spent by background tasks such as compaction',
+    ['task', 'stage', 'kind']
+)
+BACKGROUND_COST = Counter(
+    'bents_background_cost_usd_total', 'Estimated OpenAI spend by background tasks', ['task']
+)
+EMBED_BATCH_SIZE = Histogram(
+    'bents_embed_batch_size', 'Distinct query texts per batched embeddings call',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+EMBED_QUEUE_DEPTH = Histogram(
+    'bents_embed_queue_depth', 'Queries waiting in the embedding batcher when a batch is cut',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)
+)
+
+STAGE_TAG_PREFIX = 'stage:'
+
+# USD per million (prompt, completion) tokens, matched by model-name prefix
+MODEL_PRICES = {
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4.1-nano': (0.10, 0.40),
+    'gpt-4.1-mini': (0.40, 1.60),
+    'gpt-4.1': (2.00, 8.00),
+    'gpt-3.5-turbo': (0.50, 1.50),
+}
+
+
+@contextmanager
+def stage_timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_LATENCY.labels(stage).observe(elapsed)
+        logging.debug(f"Stage {stage} took {elapsed * 1000:.1f}ms")
+
+
+def record_embed_batch(batch_size, queue_depth):
+    EMBED_BATCH_SIZE.observe(batch_size)
+    EMBED_QUEUE_DEPTH.observe(queue_depth)
+
+
+def model_price(model):
+    for prefix in sorted(MODEL_PRICES, key=len, reverse=True):
+        if model and model.startswith(prefix):
+            return MODEL_PRICES[prefix]
+    return None
+
+
+class TokenUsage:
+    """Tokens spent by one request, by stage, including retries and hidden calls."""
+
+    def __init__(self):
+        self.index = 'unknown'
+        self.path = None
+        self.stages = {}
+        self.cost_usd = 0.0
+        self._token = None
+
+    def add(self, stage, model, prompt_tokens, completion_tokens):
+        totals = self.stages.setdefault(stage, {'calls': 0, 'prompt': 0, 'completion': 0})
+        totals['calls'] += 1
+        totals['prompt'] += prompt_tokens
+        totals['completion'] += completion_tokens
+        price = model_price(model)
+        if price is None:
+            logging.debug(f"No price for model {model}; its tokens are not costed")
+        else:
+            self.cost_usd += (prompt_tokens * price[0] + completion_tokens * price[1]) / 1_000_000
+
+    def as_dict(self):
+        return {
+            'index': self.index,
+            'path': self.path,
+            'prompt_tokens': sum(t['prompt'] for t in self.stages.values()),
+            'completion_tokens': sum(t['completion'] for t in self.stages.values()),
+            'llm_calls': sum(t['calls'] for t in self.stages.values()),
+            'cost_usd': round(self.cost_usd, 6),
+            'stages': self.stages,
+        }
+
+
+_current_usage = contextvars.ContextVar('token_usage', default=None)
+
+
+def begin_token_usage():
+    usage = TokenUsage()
+    usage._token = _current_usage.set(usage)
+    return usage
+
+
+def end_token_usage(usage):
+    _current_usage.reset(usage._token)
+
+
+def set_response_path(path):
+    usage = _current_usage.get()
+    if usage is not None:
+        usage.path = path
+
+
+def record_token_usage(usage):
+    # A request that ended without choosing a path raised
+    usage.path = usage.path or 'error'
+    index, path = usage.index, usage.path
+    CHAT_REQUESTS.labels(index, path).inc()
+    for stage, totals in usage.stages.items():
+        for kind in ('prompt', 'completion'):
+            if totals[kind]:
+                CHAT_TOKENS.labels(index, path, stage, kind).inc(totals[kind])
+    if usage.cost_usd:
+        CHAT_COST.labels(index, path).inc(usage.cost_usd)
+
+
+def record_background_usage(task, usage):
+    # Kept apart from the chat counters so background work does not count as requests
+    for stage, totals in usage.stages.items():
+        for kind in ('prompt', 'completion'):
+            if totals[kind]:
+                BACKGROUND_TOKENS.labels(task, stage, kind).inc(totals[kind])
+    if usage.cost_usd:
+        BACKGROUND_COST.labels(task).inc(usage.cost_usd)
+
+
+def record_cache(cache, hit):
+    CACHE_LOOKUPS.labels(cache).inc()
+    if not hit:
+        CACHE_MISSES.labels(cache).inc()
+
+
+def stage_from_tags(tags, default='unknown'):
+    for tag in tags or []:
+        if tag.startswith(STAGE_TAG_PREFIX):
+            return tag[len(STAGE_TAG_PREFIX):]
+    return default
+
+
+class StageMetricsHandler(BaseCallbackHandler):
+    """Times LLM and retriever runs and counts tokens, labelled by stage tag."""
+
+    def __init__(self):
+        self._runs = {}
+
+    def _start(self, run_id, stage):
+        self._runs[run_id] = (stage, time.perf_counter())
+
+    def _end(self, run_id, error=False):
+        stage, start = self._runs.pop(run_id, (None, None))
+        if stage is None:
+            return None
+        STAGE_LATENCY.labels(stage).observe(time.perf_counter() - start)
+        if error:
+            STAGE_ERRORS.labels(stage).inc()
+        return stage
+
+    def on_llm_start(self, serialized, prompts, *, run_id, tags=None, **kwargs):
+        self._start(run_id, stage_from_tags(tags, 'llm'))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, tags=None, **kwargs):
+        self._start(run_id, stage_from_tags(tags, 'llm'))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        stage = self._end(run_id) or 'llm'
+        llm_output = response.llm_output or {}
+        usage = llm_output.get('token_usage') or {}
+        for kind in ('prompt_tokens', 'completion_tokens'):
+            if usage.get(kind):
+                LLM_TOKENS.labels(stage, kind.replace('_tokens', '')).inc(usage[kind])
+        # Callbacks run on the calling thread, so this is the request's own usage
+        request_usage = _current_usage.get()
+        if request_usage is not None:
+            request_usage.add(
+                stage, llm_output.get('model_name'),
+                usage.get('prompt_tokens') or 0, usage.get('completion_tokens') or 0
+            )
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
+
+    def on_retriever_start(self, serialized, query, *, run_id, tags=None, **kwargs):
+        self._start(run_id, stage_from_tags(tags, 'retrieval'))
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
+
+
+metrics_handler = StageMetricsHandler()
+
+
+def stage_config(stage):
+    """Runnable config that tags a call with its stage and attaches the metrics handler."""
+    return {'callbacks': [metrics_handler], 'tags': [f'{STAGE_TAG_PREFIX}{stage}']}
+
+
+def collecting_registry():
+    # Under a preforking server each worker keeps its own counters; aggregate them
+    # through PROMETHEUS_MULTIPROC_DIR when it is set.
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def render_metrics():
+    return generate_latest(collecting_registry()), CONTENT_TYPE_LATEST
+
+
+def usage_report():
+    """Chat token and cost totals since the server started, overall and by index,
+    response path and stage. Background tasks are reported separately and are not
+    part of the chat totals."""
+    def bucket():
+        return {'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cost_usd': 0.0}
+
+    totals = bucket()
+    by_index, by_path, by_stage, background = {}, {}, {}, {}
+    for metric in collecting_registry().collect():
+        for sample in metric.samples:
+            labels, value = sample.labels, sample.value
+            if sample.name == 'bents_background_tokens_total':
+                background.setdefault(labels['task'], bucket())[f"{labels['kind']}_tokens"] += value
+                continue
+            if sample.name == 'bents_background_cost_usd_total':
+                background.setdefault(labels['task'], bucket())['cost_usd'] += value
+                continue
+            if sample.name == 'bents_chat_requests_total':
+                field = 'requests'
+            elif sample.name == 'bents_chat_tokens_total':
+                field = f"{labels['kind']}_tokens"
+                by_stage.setdefault(labels['stage'], bucket())[field] += value
+            elif sample.name == 'bents_chat_cost_usd_total':
+                field = 'cost_usd'
+            else:
+                continue
+            for target in (totals, by_index.setdefault(labels['index'], bucket()),
+                           by_path.setdefault(labels['path'], bucket())):
+                target[field] += value
+
+    for entry in [totals, *by_index.values(), *by_path.values(), *by_stage.values()]:
+        for field in ('requests', 'prompt_tokens', 'completion_tokens'):
+            entry[field] = int(entry[field])
+        entry['cost_usd'] = round(entry['cost_usd'], 6)
+        if entry['requests']:
+            entry['tokens_per_request'] = round(
+                (entry['prompt_tokens'] + entry['completion_tokens']) / entry['requests'], 1
+            )
+    for entry in by_stage.values():
+        # Stages are not requests, and cost is only tracked per index and path
+        del entry['requests'], entry['cost_usd']
+    for entry in background.values():
+        del entry['requests']
+        for field in ('prompt_tokens', 'completion_tokens'):
+            entry[field] = int(entry[field])
+        entry['cost_usd'] = round(entry['cost_usd'], 6)
+    return {
+        'totals': totals, 'by_index': by_index, 'by_path': by_path, 'by_stage': by_stage,
+        'background': background,
+    }
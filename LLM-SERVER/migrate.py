@@ -0,0 +1,73 @@
+"""Apply the SQL files in migrations/ to the products database.
+
+Usage:
+    python migrate.py            # apply pending migrations
+    python migrate.py --status   # list applied and pending migrations
+
+Each file runs in its own transaction and is recorded in schema_migrations,
+so re-running is safe.
+"""
+import os
+import sys
+import logging
+import psycopg2
+from dotenv import load_dotenv
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+logging.basicConfig(level=logging.INFO)
+
+
+def list_migrations():
+    return sorted(f for f in os.listdir(MIGRATIONS_DIR) if f.endswith('.sql'))
+
+
+def get_applied(conn):
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version TEXT PRIMARY KEY,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+        """)
+        cur.execute("SELECT version FROM schema_migrations")
+        applied = {row[0] for row in cur.fetchall()}
+    conn.commit()
+    return applied
+
+
+def apply_migration(conn, filename):
+    with open(os.path.join(MIGRATIONS_DIR, filename)) as f:
+        sql = f.read()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql)
+            cur.execute("INSERT INTO schema_migrations (version) VALUES (%s)", (filename,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def migrate(status_only=False):
+    conn = psycopg2.connect(os.getenv("POSTGRES_URL"))
+    try:
+        applied = get_applied(conn)
+        pending = [m for m in list_migrations() if m not in applied]
+        if status_only:
+            for m in list_migrations():
+                logging.info(f"{'applied' if m in applied else 'pending'}  {m}")
+            return pending
+        for m in pending:
+            logging.info(f"Applying migration {m}")
+            apply_migration(conn, m)
+        if not pending:
+            logging.info("Database schema is up to date")
+        return pending
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    migrate(status_only='--status' in sys.argv[1:])
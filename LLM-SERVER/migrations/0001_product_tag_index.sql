@@ -0,0 +1,38 @@
+-- Normalize products.tags into a text[] column and index it.
+--
+-- products.tags stays the comma-joined source of truth (the Express backend
+-- still writes it directly); a trigger keeps tag_list in sync so readers never
+-- have to split strings. The trigram index lets the substring search in
+-- get_matched_products use an index instead of a sequential scan.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE products ADD COLUMN IF NOT EXISTS tag_list text[] NOT NULL DEFAULT '{}';
+
+CREATE OR REPLACE FUNCTION products_sync_tag_list() RETURNS trigger AS $$
+BEGIN
+    NEW.tag_list := COALESCE(
+        ARRAY(
+            SELECT btrim(t)
+            FROM unnest(string_to_array(NEW.tags, ',')) AS t
+            WHERE btrim(t) <> ''
+        ),
+        '{}'
+    );
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS products_sync_tag_list ON products;
+CREATE TRIGGER products_sync_tag_list
+    BEFORE INSERT OR UPDATE OF tags ON products
+    FOR EACH ROW EXECUTE FUNCTION products_sync_tag_list();
+
+-- Backfill existing rows by firing the trigger.
+UPDATE products SET tags = tags;
+
+CREATE INDEX IF NOT EXISTS products_tags_trgm_idx
+    ON products USING gin (LOWER(tags) gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS products_tag_list_idx
+    ON products USING gin (tag_list);
@@ -0,0 +1,7 @@
+-- Content address for product images, used by the /product_image endpoint.
+-- Generated from image_data so it can never drift from the stored bytes.
+
+ALTER TABLE products ADD COLUMN IF NOT EXISTS image_hash text
+    GENERATED ALWAYS AS (encode(sha256(image_data), 'hex')) STORED;
+
+CREATE INDEX IF NOT EXISTS products_image_hash_idx ON products (image_hash);
@@ -0,0 +1,14 @@
+-- Server-side conversation history for /chat. Clients send a conversation_id
+-- and only the new message; each answered turn is appended as one row.
+
+CREATE TABLE IF NOT EXISTS conversation_turns (
+    id BIGSERIAL PRIMARY KEY,
+    conversation_id UUID NOT NULL,
+    selected_index TEXT NOT NULL,
+    question TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS conversation_turns_conversation_idx
+    ON conversation_turns (conversation_id, id DESC);
@@ -0,0 +1,9 @@
+-- Running summary of conversation turns older than the verbatim window.
+-- summarized_through is the last conversation_turns.id folded into the summary.
+
+CREATE TABLE IF NOT EXISTS conversation_summaries (
+    conversation_id UUID PRIMARY KEY,
+    summary TEXT NOT NULL,
+    summarized_through BIGINT NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
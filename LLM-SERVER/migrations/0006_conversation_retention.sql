@@ -0,0 +1,5 @@
+-- Conversation history is kept for CONVERSATION_RETENTION_DAYS; the app prunes
+-- older turns and stale summaries by age, so both need an index on it.
+
+CREATE INDEX IF NOT EXISTS conversation_turns_created_idx ON conversation_turns (created_at);
+CREATE INDEX IF NOT EXISTS conversation_summaries_updated_idx ON conversation_summaries (updated_at);
@@ -0,0 +1,92 @@
+"""Request-scoped stack sampling for the chat pipeline.
+
+A StackSampler polls the stack of a single request thread on a background
+thread and aggregates it into folded stacks ("frame;frame;frame count"), the
+format read by flamegraph.pl, speedscope and inferno. Nothing runs unless a
+request opts in, so there is no overhead when profiling is off.
+"""
+import os
+import re
+import sys
+import time
+import uuid
+import threading
+from collections import Counter
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/bents-profiles")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+
+PROFILE_ID_PATTERN = re.compile(r'[0-9]{8}T[0-9]{6}-[0-9a-f]{32}')
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._started_at = None
+        self.elapsed = 0.0
+
+    def start(self):
+        self._started_at = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self._started_at
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def new_profile_id():
+    return f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{uuid.uuid4().hex}"
+
+
+def profile_path(profile_id):
+    if not PROFILE_ID_PATTERN.fullmatch(profile_id):
+        return None
+    return os.path.join(PROFILE_DIR, f"{profile_id}.folded")
+
+
+def save_profile(profile_id, sampler):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(profile_path(profile_id), 'w') as f:
+        f.write(sampler.folded())
+    # Keep only the newest PROFILE_KEEP profiles
+    for old in list_profiles()[PROFILE_KEEP:]:
+        try:
+            os.remove(profile_path(old))
+        except OSError:
+            pass
+
+
+def list_profiles():
+    """Profile ids, newest first."""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    ids = [f[:-len('.folded')] for f in os.listdir(PROFILE_DIR) if f.endswith('.folded')]
+    return sorted((i for i in ids if PROFILE_ID_PATTERN.fullmatch(i)), reverse=True)
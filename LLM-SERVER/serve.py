@@ -0,0 +1,92 @@
+"""Production entry point: gunicorn with a preloaded app and warm workers.
+
+The app is imported once in the master (preload) so heavy imports and
+module-level clients are shared copy-on-write by the forked workers. Each
+worker then runs app.warmup() before it accepts traffic, and /ready reports
+503 while any warmup step is failing.
+
+Several workers need shared job state (JOB_STORE=postgres, the default with
+Pinecone). With VECTOR_STORE_BACKEND=memory or JOB_STORE=memory, vectors and
+upload job status live in one process, so the default drops to one worker.
+
+Usage:
+    python serve.py                       # WEB_WORKERS / WEB_THREADS / PORT from the environment
+    python serve.py --workers 4 --threads 16 --port 8000
+"""
+import os
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+# prometheus_client reads this at import time, so it must be set before the app loads
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "bents-prometheus"))
+# Workers are long-running, so uploads and compaction can finish after the response
+os.environ.setdefault("BACKGROUND_JOBS", "1")
+
+from gunicorn.app.base import BaseApplication
+
+
+def post_worker_init(worker):
+    import app as app_module
+    app_module.warmup()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+class ProductionServer(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        import app as app_module
+        return app_module.app
+
+
+def default_workers():
+    # Mirrors app.JOB_STORE's default; per-process state cannot be spread over workers
+    vector_store = os.getenv("VECTOR_STORE_BACKEND", "pinecone")
+    job_store = os.getenv("JOB_STORE", "memory" if vector_store == "memory" else "postgres")
+    if vector_store == "memory" or job_store == "memory":
+        return 1
+    return multiprocessing.cpu_count() + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument('--port', type=int, default=int(os.getenv("PORT", "5000")))
+    parser.add_argument('--workers', type=int, default=int(os.getenv("WEB_WORKERS", str(default_workers()))))
+    # Requests mostly wait on OpenAI/Pinecone, so each worker runs several threads
+    parser.add_argument('--threads', type=int, default=int(os.getenv("WEB_THREADS", "8")))
+    parser.add_argument('--timeout', type=int, default=int(os.getenv("WEB_TIMEOUT", "120")))
+    args = parser.parse_args()
+
+    # Start each run with empty per-worker metric files
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+    ProductionServer({
+        'bind': f'{args.host}:{args.port}',
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread',
+        'timeout': args.timeout,
+        'preload_app': True,
+        'post_worker_init': post_worker_init,
+        'child_exit': child_exit,
+        'accesslog': '-',
+    }).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""Route questions that name a video to that video's transcript chunks.
+
+TitleMatcher is a small inverted index over the known video titles. Question
+tokens are matched exactly or, for longer words, to the closest title token
+(typo tolerance). Titles are scored by the IDF-weighted share of their tokens
+the question covers, and titles scoring close to the best one are returned
+together so duplicate and near-duplicate titles route as a group.
+
+Only distinctive tokens count: the channel's everyday vocabulary (tools,
+woodworking, shop, best...) appears in generic questions as much as in titles,
+so it is left out of both sides. Otherwise "What are the 10 best woodworking
+tools?" would be pinned to one of the many "10 ... tools" videos.
+"""
+import re
+import math
+import difflib
+from collections import Counter, defaultdict
+from langchain_core.retrievers import BaseRetriever
+
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'could', 'did', 'do', 'does', 'for', 'from',
+    'how', 'i', 'in', 'is', 'it', 'me', 'my', 'new', 'not', 'of', 'on', 'or', 'part', 'should', 'so',
+    'that', 'the', 'these', 'this', 'to', 'use', 'used', 'using', 'video', 'was', 'what', 'when', 'where',
+    'which', 'who', 'why', 'will', 'with', 'would', 'you', 'your',
+}
+GENERIC_TOKENS = {
+    'best', 'favorite', 'good', 'great', 'most', 'recommend', 'recommended', 'shop', 'shops', 'some', 'tip',
+    'tips', 'tool', 'tools', 'top', 'woodworker', 'woodworkers', 'woodworking',
+}
+
+
+def content_tokens(text):
+    return [t for t in re.findall(r'[a-z0-9]+', text.lower()) if t not in STOPWORDS and t not in GENERIC_TOKENS]
+
+
+class TitleMatcher:
+    """
+    >>> matcher = TitleMatcher([
+    ...     "10 Woodworking tools you will not regret", "10 Tools Every Woodworker Should Own",
+    ...     "25 tools I regret not buying sooner", "8 Tools I Regret Not Buying Sooner",
+    ...     "2020 Shop Tour", "Complete Mr Cool Install", "How To Install Mr Cool DIY Series",
+    ... ])
+
+    Generic questions, including the frontend's starter questions, are not routed:
+
+    >>> matcher.match("What are the 10 most recommended woodworking tools?")
+    []
+    >>> matcher.match("What are the 10 best woodworking tools?")
+    []
+    >>> matcher.match("Suggest me some shop layout tips?")
+    []
+    >>> matcher.match("What are the benefits of LR32 system for cabinetry?")
+    []
+
+    Questions naming a video are, with its near-duplicates:
+
+    >>> matcher.match("In the 2020 shop tour, where is the table saw?")
+    ['2020 Shop Tour']
+    >>> matcher.match("Which tools do you regret not buying sooner?")
+    ['25 tools I regret not buying sooner', '8 Tools I Regret Not Buying Sooner']
+    >>> matcher.match("How long did the Mr Cool install take?")
+    ['Complete Mr Cool Install', 'How To Install Mr Cool DIY Series']
+    """
+
+    def __init__(self, titles, min_score=0.6, relative_score=0.75, min_tokens=2, fuzzy_cutoff=0.85):
+        # Exact duplicates collapse to one entry
+        self.titles = list(dict.fromkeys(titles))
+        self.min_score = min_score
+        self.relative_score = relative_score
+        self.min_tokens = min_tokens
+        self.fuzzy_cutoff = fuzzy_cutoff
+
+        # Titles made only of generic words can never be matched
+        self._tokens = {title: toks for title in self.titles if (toks := set(content_tokens(title)))}
+        df = Counter(tok for toks in self._tokens.values() for tok in toks)
+        n = len(self.titles)
+        self._idf = {tok: math.log((n + 1) / (count + 0.5)) for tok, count in df.items()}
+        self._index = defaultdict(set)
+        for title, toks in self._tokens.items():
+            for tok in toks:
+                self._index[tok].add(title)
+        self._vocab = sorted(self._index)
+        self._weight = {title: sum(self._idf[t] for t in toks) for title, toks in self._tokens.items()}
+
+    def _resolve(self, token):
+        if token in self._index:
+            return token
+        if len(token) >= 4:
+            close = difflib.get_close_matches(token, self._vocab, n=1, cutoff=self.fuzzy_cutoff)
+            if close:
+                return close[0]
+        return None
+
+    def match(self, text):
+        """Titles the text refers to, best first; empty when nothing matches well enough."""
+        query = {r for r in (self._resolve(t) for t in content_tokens(text)) if r}
+        candidates = set().union(*(self._index[t] for t in query)) if query else set()
+
+        scores = {}
+        for title in candidates:
+            matched = query & self._tokens[title]
+            if len(matched) < min(self.min_tokens, len(self._tokens[title])):
+                continue
+            # Rounded so float summation order (set iteration) cannot break ties
+            scores[title] = round(sum(self._idf[t] for t in matched) / self._weight[title], 9)
+        if not scores:
+            return []
+
+        best = max(scores.values())
+        if best < self.min_score:
+            return []
+        # Near-duplicates of the best title route with it, even below min_score
+        threshold = best * self.relative_score
+        return sorted((t for t, s in scores.items() if s >= threshold), key=lambda t: (-scores[t], t))
+
+
+class TitleRoutedRetriever(BaseRetriever):
+    """Similarity search restricted to matched video titles, falling back to the
+    whole index when no title matches or the filtered search finds nothing."""
+    vector_store: object
+    matcher: object
+    make_filter: object
+    k: int = 3
+    on_route: object = None
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        # Embed once; the fallback search reuses the vector
+        vector = self.vector_store.embeddings.embed_query(query)
+        titles = self.matcher.match(query)
+        if titles:
+            docs = self.vector_store.similarity_search_by_vector(vector, k=self.k, filter=self.make_filter(titles))
+            if docs:
+                self._report('matched')
+                return docs
+            self._report('fallback')
+        else:
+            self._report('unmatched')
+        return self.vector_store.similarity_search_by_vector(vector, k=self.k)
+
+    def _report(self, result):
+        if self.on_route is not None:
+            self.on_route(result)
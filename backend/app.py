@@ -514,5 +514,6 @@ def retry_llm_call(qa_chain, query, chat_history):
         raise LLMNoResponseError("LLM failed due to an unexpected error")
 
 if __name__ == '__main__':
+    # Development server only; the debugger and reloader stay off unless FLASK_DEBUG=1
     verify_database()
-    app.run(debug=True, port=5000)
+    app.run(debug=os.getenv("FLASK_DEBUG") == "1", port=5000)
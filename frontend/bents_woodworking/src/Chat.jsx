@@ -28,6 +28,7 @@ export default function Chat({ isVisible }) {
   const [isLoading, setIsLoading] = useState(false);
   const [loadingQuestionIndex, setLoadingQuestionIndex] = useState(null);
   const [selectedIndex, setSelectedIndex] = useState("bents");
+  const [conversationId, setConversationId] = useState(null);
   const [isInitialized, setIsInitialized] = useState(false);
   const [isSearching, setIsSearching] = useState(false);
   const latestConversationRef = useRef(null);
@@ -56,6 +57,7 @@ export default function Chat({ isVisible }) {
       setConversations(parsedData.conversations || []);
       setSearchHistory(parsedData.searchHistory || []);
       setSelectedIndex(parsedData.selectedIndex || "bents");
+      setConversationId(parsedData.conversationId || null);
       setShowInitialQuestions(parsedData.conversations.length === 0);
       setShowCenterSearch(parsedData.conversations.length === 0);
       setIsInitialized(true);
@@ -93,10 +95,11 @@ export default function Chat({ isVisible }) {
       sessionStorage.setItem('chatData', JSON.stringify({
         conversations,
         searchHistory,
-        selectedIndex
+        selectedIndex,
+        conversationId
       }));
     }
-  }, [conversations, searchHistory, selectedIndex, isInitialized]);
+  }, [conversations, searchHistory, selectedIndex, conversationId, isInitialized]);
 
   useEffect(() => {
     if (!isVisible && isSearching) {
@@ -126,7 +129,13 @@ export default function Chat({ isVisible }) {
       const response = await axios.post('https://bents-model-backend.vercel.app/chat', {
         message: query,
         selected_index: selectedIndex,
-        chat_history: conversations.flatMap(conv => [conv.question, conv.initial_answer || conv.text])
+        // History lives server-side once we have a conversation id; only send it for
+        // conversations restored without one
+        conversation_id: conversationId,
+        ...(conversationId ? {} : {
+          chat_history: conversations.flatMap(conv => [conv.question, conv.initial_answer || conv.text])
+        }),
+        fields: ['response', 'initial_answer', 'url', 'related_products', 'video_links', 'conversation_id']
       }, {
         timeout: 60000 // 60 seconds timeout
       });
@@ -140,6 +149,9 @@ export default function Chat({ isVisible }) {
         videoLinks: response.data.video_links
       };
       setConversations(prevConversations => [...prevConversations, newConversation]);
+      if (response.data.conversation_id) {
+        setConversationId(response.data.conversation_id);
+      }
       setSearchHistory(prevHistory => [...prevHistory, query]);
       setShowInitialQuestions(false);
       setSearchQuery("");
@@ -159,6 +171,7 @@ export default function Chat({ isVisible }) {
 
   const handleNewConversation = () => {
     setConversations([]);
+    setConversationId(null);
     setShowInitialQuestions(true);
     setShowCenterSearch(true);  // Show center search for new conversation
   };